@@ -1,16 +1,34 @@
 import tkinter as tk
 from tkinter import filedialog
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-import h5py
+from tkinter import ttk
 import numpy as np
 import re
 from PIL import Image, ImageTk
 import os
 import subprocess
+import queue
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
-import get_conventional as con
-import get_radiomics as radio
+import manifest
+import thumbnails
+from slice_cache import SliceCache
+from display import DisplayLoader, render
+from parallel import Cancelled
+
+# The extraction backends (scipy, SimpleITK, pyradiomics) are imported the
+# first time an extract button is used, inside the extraction thread, so the
+# viewer starts without them. startup_check.py keeps an eye on this.
+def run_conventional(*args, **kwargs):
+    import get_conventional
+    return get_conventional.get_all(*args, **kwargs)
+
+
+def run_radiomics(*args, **kwargs):
+    import get_radiomics
+    return get_radiomics.get_all_radiomics(*args, **kwargs)
 
 
 def find_volume_number(file_path):
@@ -38,6 +56,10 @@ class MriApp:
         self.mask=None
         self.mode=0 # 0: image/1: masked
         self.file_path = 'archive/BraTS2020_training_data'
+        # slices are loaded and prefetched in the background, see slice_cache.py,
+        # and arrive display ready (uint8, rotated), see display.py
+        self.display_loader = DisplayLoader(on_ranges=lambda volume_dir: self.slice_cache.reload(volume_dir))
+        self.slice_cache = SliceCache(loader=self.display_loader)
 
 
         # This is based on feature selection
@@ -79,12 +101,21 @@ class MriApp:
         # 'Load Slice Directory' Button
         self.load_button = tk.Button(master, text='Load Slice Directory', command=self.load_directory)
         self.load_button.grid(row=8, column=0, sticky='w')
+
+        # montage of the whole volume from the previews in thumbnails.h5,
+        # clicking a tile shows that slice
+        self.montage = None
+        self.montage_mode = False
+        self.preview_executor = ThreadPoolExecutor(max_workers=1)
+        self.montage_button = tk.Button(master, text='Montage', command=self.toggle_montage)
+        self.montage_button.grid(row=8, column=1, sticky='e')
+        self.image_label.bind('<Button-1>', self.click_image)
        
         # to select channel
         self.channel_var = tk.StringVar(master)
         self.channel_var.set("T1")  # set default
         self.channel_options = ['T1', 'T1Gd', 'T2', 'T2-FLAIR']
-        self.channel_menu = tk.OptionMenu(master, self.channel_var, *self.channel_options,command=self.load_directory)
+        self.channel_menu = tk.OptionMenu(master, self.channel_var, *self.channel_options,command=self.redraw)
         self.channel_menu.grid(row=9, column=1)
 
         self.channel_label = tk.Label(master, text="Channel:")
@@ -99,7 +130,7 @@ class MriApp:
        
        
         # 【TODO】
-        self.annotation_menu = tk.OptionMenu(master, self.annotation_var, *self.annotation_options)
+        self.annotation_menu = tk.OptionMenu(master, self.annotation_var, *self.annotation_options, command=self.redraw)
         self.annotation_menu.grid(row=10, column=1)
 
         self.annotation_label = tk.Label(master, text="Annotation:")
@@ -125,44 +156,102 @@ class MriApp:
         # button to extract radiomic features
         self.extract_radiomic_button = tk.Button(master, text='Extract Radiomic Features', command=self.extract_radiomic_features)
         self.extract_radiomic_button.grid(row=12, column=1, sticky='e')
+
+        # extraction runs in a background thread (one run at a time) so the viewer
+        # stays usable; progress comes back through a queue polled with after()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.progress_queue = queue.Queue()
+        self.cancel_event = threading.Event()
+        self.progress_bar = ttk.Progressbar(master, orient='horizontal', mode='determinate')
+        self.progress_bar.grid(row=13, column=0, columnspan=2, sticky='we')
+        self.progress_label = tk.Label(master, text="")
+        self.progress_label.grid(row=14, column=0, sticky='w')
+        self.cancel_button = tk.Button(master, text='Cancel', command=self.cancel_extraction, state='disabled')
+        self.cancel_button.grid(row=14, column=1, sticky='e')
     
     def extract_conventional_features(self):
         self.path_subfolders=filedialog.askdirectory()
+        if not self.path_subfolders:
+            return
         print("Extracting conventional features...")
-        con.get_all(self.path_subfolders)
-        if os.path.exists(self.path_subfolders):  # Check if the directory exists
-            subprocess.run(["open" if os.name == 'posix' else "explorer", self.path_subfolders], check=True)
-        
+        self.start_extraction(run_conventional, self.path_subfolders)
             
     
     def extract_radiomic_features(self):
         self.path_subfolders=filedialog.askdirectory()
+        if not self.path_subfolders:
+            return
         print("Extracting radiomic features...")
-        radio.get_all_radiomics(self.path_subfolders,col_list=self.radiomic_feature_list)
+        self.start_extraction(run_radiomics, self.path_subfolders, col_list=self.radiomic_feature_list)
+
+    def start_extraction(self, function, *args, **kwargs):
+        self.cancel_event.clear()
+        self.extract_conventional_button.config(state='disabled')
+        self.extract_radiomic_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.progress_bar['value'] = 0
+        self.progress_label.config(text="Starting...")
+        self.started = None
+        # leave one core for the viewer
+        workers = max(1, (os.cpu_count() or 1) - 1)
+        # spawned workers: a fork of this process would copy Tk and whatever lock
+        # the prefetch thread holds (h5py) at that moment
+        future = self.executor.submit(function, *args, workers=workers, progress=self.report_progress,
+                                      cancel=self.cancel_event, mp_context=multiprocessing.get_context('spawn'),
+                                      **kwargs)
+        self.master.after(100, self.poll_extraction, future)
+
+    # called from the extraction thread, never touches Tk
+    def report_progress(self, done, total):
+        self.progress_queue.put((time.time(), done, total))
+
+    def poll_extraction(self, future):
+        while not self.progress_queue.empty():
+            now, done, total = self.progress_queue.get()
+            if self.started is None:
+                # first report: volumes already cached, the ETA starts from here
+                self.started = (now, done)
+            self.progress_bar['maximum'] = max(total, 1)
+            self.progress_bar['value'] = done
+            text = f"{done}/{total} volumes"
+            start_time, start_done = self.started
+            if done > start_done:
+                remaining = (now - start_time) / (done - start_done) * (total - done)
+                text += f", about {int(remaining // 60)} min {int(remaining % 60)} s left"
+            self.progress_label.config(text=text)
+
+        if not future.done():
+            self.master.after(100, self.poll_extraction, future)
+            return
+
+        self.extract_conventional_button.config(state='normal')
+        self.extract_radiomic_button.config(state='normal')
+        self.cancel_button.config(state='disabled')
+        try:
+            future.result()
+        except Cancelled:
+            self.progress_label.config(text="Cancelled (finished volumes are cached)")
+            return
+        except Exception as exception:
+            self.progress_label.config(text=f"Failed: {exception}")
+            raise
+        self.progress_label.config(text="Done")
         if os.path.exists(self.path_subfolders):  # Check if the directory exists
             subprocess.run(["open" if os.name == 'posix' else "explorer", self.path_subfolders], check=True)
 
+    def cancel_extraction(self):
+        self.cancel_event.set()
+        self.progress_label.config(text="Cancelling after the running volumes...")
+
     def load_image(self, mode=0):  # 0: image / 1: masked
         # Show selected channel
         channel_names = ['T1', 'T1Gd', 'T2', 'T2-FLAIR']
         channel_id = channel_names.index(self.channel_var.get())
-        channel_image = self.image[channel_id, :, :]
 
-        # Normalize the image array to 0-255
-        normalized_array = (channel_image - channel_image.min()) / (channel_image.max() - channel_image.min())
-
-        if mode == 1:  # Show photo with mask
-            sum_mask = self.mask[0, :, :] + self.mask[1, :, :] + self.mask[2, :, :]
-            yellow_mask = np.stack([sum_mask, sum_mask, np.zeros_like(sum_mask)], axis=-1)
-            rgb_image = np.stack([normalized_array] * 3, axis=-1)
-            overlay_image = (rgb_image) + (yellow_mask * 0.5)
-            normalized_array = (overlay_image - overlay_image.min()) / (overlay_image.max() - overlay_image.min())
-
-        scaled_array = (255 * normalized_array).astype(np.uint8)
-
-        # Rotate the image counterclockwise by 90 degrees
-        pil_image = Image.fromarray(scaled_array).rotate(90,
-                                                         expand=True)  # `expand=True` adjusts the size to fit the new orientation
+        # self.image / self.mask are already normalised per volume, rotated and
+        # uint8, so a frame is an index (+ lookup table blend for the mask)
+        frame = render(self.image, self.mask, channel_id, annotate=(mode == 1))
+        pil_image = Image.fromarray(frame)
 
         self.photo_image = ImageTk.PhotoImage(pil_image)
         self.image_label.config(image=self.photo_image)
@@ -171,31 +260,52 @@ class MriApp:
         # Explicitly update the widget
         self.image_label.update_idletasks()  # Use this if the rotation still doesn't appear
 
+    # channel or annotation changed: redraw the current slice, nothing is reloaded
+    def redraw(self, *args):
+        if self.montage_mode:
+            self.show_montage()
+        elif self.image is not None:
+            self.mode = 1 if self.annotation_var.get() == 'On' else 0
+            self.load_image(mode=self.mode)
+
     def load_directory(self):
         self.file_path = filedialog.askdirectory()
         self.change_slice_id()
 
 
     def change_slice_id(self, value=10):    
+        self.leave_montage()
         if self.file_path:
             print("Directory chosen:", self.file_path)
             volume_number = find_volume_number(self.file_path)
             print(volume_number)
             
-            data = {} # to load h5 file
-            # file_name = self.file_path + "/volume_" + volume_number + "_slice_" + str(self.slice_id_slider.get()) + ".h5"
-            file_name = os.path.join(self.file_path, f"volume_{volume_number}_slice_{self.slice_id_slider.get()}.h5")
-
-            # print(file_name)
-            with h5py.File(file_name, 'r') as file:
-                # self.dataset = file['image'].transpose(2,0,1)
-                for key in file.keys():  # keys: image & mask
-                    data[key] = file[key][()]          
-                self.image = data['image'].transpose(2, 0, 1)
-                self.mask = data['mask'].transpose(2, 0, 1)
-                # annotation mode
-                self.mode = 1 if self.annotation_var.get() == 'On' else 0
-                self.load_image(mode=self.mode)
+            # only show slices from the cache, the background thread loads
+            # (packed.h5 or volume_N_slice_K.h5) and prefetches the rest
+            slice_id = self.slice_id_slider.get()
+            self.slice_cache.set_volume(self.file_path)
+            self.slice_cache.request(slice_id)
+            self.show_slice(slice_id)
+
+    # shown is the frame already on screen (polling for the volume's range)
+    def show_slice(self, slice_id, shown=None):
+        if slice_id != self.slice_id_slider.get() or self.montage_mode:
+            return  # the slider moved on (or the montage is up), skip this stale slice
+        data = self.slice_cache.get(slice_id)
+        if data is None:
+            if self.slice_cache.error(slice_id) is not None:
+                print("Could not load slice", slice_id, ":", self.slice_cache.error(slice_id))
+                return
+            self.master.after(10, self.show_slice, slice_id)
+            return
+        if data is not shown:
+            self.image, self.mask = data  # (channels, H, W) uint8, (H, W) overlay
+            # annotation mode
+            self.mode = 1 if self.annotation_var.get() == 'On' else 0
+            self.load_image(mode=self.mode)
+        # drawn with the slice's own range until the volume's is known, then again
+        if self.display_loader.provisional(self.file_path):
+            self.master.after(50, self.show_slice, slice_id, data)
 
     def add_annotation(self):
         if self.annotation_var.get()=='On':
@@ -230,13 +340,81 @@ class MriApp:
 
     def load_directory(self):
         self.file_path = filedialog.askdirectory()
+        # the manifest knows how many slices the volume has, the slider follows it
+        entry = manifest.volume_entry(self.file_path) if self.file_path else None
+        if entry is not None and entry['slice_ids']:
+            self.slice_id_slider.config(from_=entry['slice_ids'][0], to=entry['slice_ids'][-1])
+            self.slice_cache.num_slices = entry['slice_ids'][-1] + 1
+        self.montage = None
+        self.change_slice_id()
+
+    def toggle_montage(self):
+        if self.montage_mode:
+            self.change_slice_id()
+        elif self.file_path:
+            self.montage_mode = True
+            self.montage_button.config(text='Slice View')
+            self.show_montage()
+
+    def leave_montage(self):
+        if self.montage_mode:
+            self.montage_mode = False
+            self.montage_button.config(text='Montage')
+
+    # The montage only reads thumbnails.h5; a volume without (fresh) previews
+    # gets them built in the background first (see thumbnails.py).
+    def show_montage(self):
+        if self.montage is None or self.montage['volume_dir'] != self.file_path:
+            self.montage = thumbnails.load_montage(self.file_path)
+            if self.montage is None:
+                self.progress_label.config(text="Building previews...")
+                future = self.preview_executor.submit(thumbnails.build_thumbnails, self.file_path)
+                self.master.after(100, self.poll_previews, future, self.file_path)
+                return
+            self.montage['volume_dir'] = self.file_path
+        channel_id = self.channel_options.index(self.channel_var.get())
+        frame = thumbnails.render_montage(self.montage['channels'], self.montage['outline'], channel_id,
+                                          self.montage['columns'], annotate=self.annotation_var.get() == 'On')
+        self.photo_image = ImageTk.PhotoImage(Image.fromarray(frame))
+        self.image_label.config(image=self.photo_image)
+        self.image_label.image = self.photo_image
+
+    def poll_previews(self, future, volume_dir):
+        if not future.done():
+            self.master.after(100, self.poll_previews, future, volume_dir)
+            return
+        try:
+            built = future.result()
+        except Exception as exception:
+            self.progress_label.config(text=f"Previews failed: {exception}")
+            raise
+        self.progress_label.config(text="")
+        if built is None:
+            self.progress_label.config(text="No slices in this directory")
+            self.leave_montage()
+        elif self.montage_mode and volume_dir == self.file_path:
+            self.show_montage()
+
+    # a click on a montage tile jumps to that slice
+    def click_image(self, event):
+        if not self.montage_mode or self.montage is None:
+            return
+        # the image is centred in the label
+        x = event.x - (self.image_label.winfo_width() - self.photo_image.width()) // 2
+        y = event.y - (self.image_label.winfo_height() - self.photo_image.height()) // 2
+        index = thumbnails.tile_at(x, y, len(self.montage['slice_ids']), self.montage['channels'].shape[2:],
+                                   self.montage['columns'])
+        if index is None:
+            return
+        self.slice_id_slider.set(int(self.montage['slice_ids'][index]))
         self.change_slice_id()
         
 
 # run this app :)
-root = tk.Tk()
-app = MriApp(root)
-root.mainloop()
+if __name__ == '__main__':
+    root = tk.Tk()
+    app = MriApp(root)
+    root.mainloop()
 
 
 
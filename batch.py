@@ -0,0 +1,151 @@
+import os
+import re
+import glob
+import argparse
+
+import get_conventional as con
+import manifest
+import volume_store
+from feature_store import merge_csv, merge_hdf5, output_formats
+
+# Command line entry point for headless runs (no tkinter), one or many machines.
+#   python batch.py extract <dir>                          # everything on this machine
+#   python batch.py extract <dir> --shard 2/4 --workers 0  # volumes of shard 2 of 4
+#   python batch.py merge <dir>                            # once all shards are done
+# A shard takes every n-th volume (shard i/n, i from 1 to n) and writes
+# <name>.shard-i-of-n.csv and/or .h5 (--formats) into --out (default <dir>);
+# merge (with the same --out) combines every format all shards have into the
+# usual conventional_features / radiomic_features tables in volume order.
+# Merging fails when a feature set of --features has no partial results. The feature cache sits in <dir>, so a shard that is rerun
+# after a crash only processes what it did not finish.
+# Radiomics is only imported when it is run, nodes that only extract
+# conventional features do not need pyradiomics.
+
+outputs = {'conventional': 'conventional_features', 'radiomics': 'radiomic_features'}
+
+# merge_<format> of every output format
+mergers = {'.csv': merge_csv, '.h5': merge_hdf5}
+
+
+# '2/4' -> (2, 4)
+def parse_shard(text):
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/n, got {text!r}")
+    if not 1 <= index <= count:
+        raise argparse.ArgumentTypeError(f"shard {index} does not exist in {count} shards")
+    return index, count
+
+
+def shard_name(name, shard):
+    return name if shard is None else f'{name}.shard-{shard[0]}-of-{shard[1]}'
+
+
+# volume numbers of one shard; listing the volume directories is enough here,
+# every shard indexing the whole cohort would defeat the point. Directories
+# without slices are left out, like get_volumes does.
+def shard_volumes(directory, shard):
+    volumes = sorted(number for name, number in manifest.volume_dirs(directory).items()
+                     if volume_store.has_slices(os.path.join(directory, name)))
+    if shard is None:
+        return volumes
+    index, count = shard
+    return volumes[index - 1::count]
+
+
+def extract(args):
+    out = args.out or args.dir
+    os.makedirs(out, exist_ok=True)
+    volumes = shard_volumes(args.dir, args.shard)
+    print(f"{len(volumes)} volumes in this run")
+    if 'conventional' in args.features:
+        con.get_all(args.dir, workers=args.workers, diameter_method=args.diameter,
+                    thickness=args.thickness if args.thickness else 5, use_cache=not args.no_cache,
+                    profile=args.profile, formats=args.formats, volumes=volumes, regions=args.regions,
+                    csv_file=os.path.join(out, shard_name(outputs['conventional'], args.shard) + '.csv'))
+    if 'radiomics' in args.features:
+        import get_radiomics as radio
+        radio.get_all_radiomics(args.dir, col_list=radio.selected_features, workers=args.workers,
+                                use_cache=not args.no_cache, profile=args.profile, formats=args.formats,
+                                volumes=volumes, regions=args.regions,
+                                csv_file_path=os.path.join(out, shard_name(outputs['radiomics'], args.shard) + '.csv'))
+
+
+# partial results of name in directory by shard number, checks that all n are
+# there. Returns the shard stems (paths without the format extension) and the
+# extensions every shard has.
+def find_shards(directory, name):
+    pattern = re.compile(re.escape(name) + r'\.shard-(\d+)-of-(\d+)(\.csv|\.h5)$')
+    found = {}
+    extensions = {}
+    for path in glob.glob(os.path.join(directory, f'{name}.shard-*-of-*.*')):
+        match = pattern.match(os.path.basename(path))
+        if match is None:
+            continue
+        index, count = int(match.group(1)), int(match.group(2))
+        stem = path[:-len(match.group(3))]
+        found.setdefault(count, {})[index] = stem
+        extensions.setdefault(stem, set()).add(match.group(3))
+    if not found:
+        return [], []
+    if len(found) > 1:
+        raise SystemExit(f"{name}: partial results of different shard counts {sorted(found)} in {directory}")
+    count, shards = found.popitem()
+    missing = sorted(set(range(1, count + 1)) - set(shards))
+    if missing:
+        raise SystemExit(f"{name}: shards {missing} of {count} are missing")
+    stems = [shards[index] for index in sorted(shards)]
+    return stems, sorted(set.intersection(*(extensions[stem] for stem in stems)))
+
+
+def merge(args):
+    out = args.out or args.dir
+    for feature_set in args.features:
+        name = outputs[feature_set]
+        stems, formats = find_shards(out, name)
+        if not stems:
+            raise SystemExit(f"{name}: no partial results (.shard-i-of-n.csv / .h5) in {out}")
+        if not formats:
+            raise SystemExit(f"{name}: the shards in {out} have no output format in common")
+        target = os.path.join(out, name)
+        for extension in formats:
+            rows = mergers[extension]([stem + extension for stem in stems], target + extension)
+            print(f"{target}{extension}: {rows} volumes from {len(stems)} shards")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless feature extraction, optionally split over several machines')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_extract = commands.add_parser('extract', help='extract features for a directory or one shard of it')
+    parser_extract.add_argument('dir')
+    parser_extract.add_argument('--features', nargs='+', choices=sorted(outputs),
+                                default=['conventional', 'radiomics'])
+    parser_extract.add_argument('--shard', type=parse_shard, help='i/n: run only shard i of n (1 <= i <= n)')
+    parser_extract.add_argument('--out', help='where the results go (default: dir)')
+    parser_extract.add_argument('--workers', type=int, default=1, help='worker processes, 0 = all cores')
+    parser_extract.add_argument('--diameter', choices=sorted(con.diameter_methods), default='angle',
+                                help='method used for Max_Tumor_Diameter')
+    parser_extract.add_argument('--thickness', type=int, nargs='+',
+                                help='outer layer thickness(es), several values give one column each (default 5)')
+    parser_extract.add_argument('--no-cache', action='store_true', help='recompute every volume')
+    parser_extract.add_argument('--profile', action='store_true', help='write per-stage timings next to the csv')
+    parser_extract.add_argument('--formats', nargs='+', choices=sorted(output_formats), default=['csv', 'hdf5'])
+    parser_extract.add_argument('--regions', action='store_true',
+                                help='also compute every feature per tumor subregion (NCR, ED, ET)')
+    parser_extract.set_defaults(run=extract)
+
+    parser_merge = commands.add_parser('merge', help='combine the shard results in dir')
+    parser_merge.add_argument('dir')
+    parser_merge.add_argument('--features', nargs='+', choices=sorted(outputs),
+                              default=['conventional', 'radiomics'])
+    parser_merge.add_argument('--out', help='where the shards were written (default: dir)')
+    parser_merge.set_defaults(run=merge)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
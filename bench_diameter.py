@@ -0,0 +1,61 @@
+import argparse
+import time
+import numpy as np
+
+import get_conventional as con
+import volume_store
+
+# Compare the 180 angle sweep with the exact convex hull (Feret) diameter on real masks
+# usage: python bench_diameter.py <data dir> [--volumes 20] [--repeat 3]
+
+
+def load_masks(volume_dir):
+    masks = []
+    for image, mask in volume_store.iter_slices(volume_dir):
+        image, mask = con.adjust_data(image, mask)
+        if np.any(mask):
+            masks.append(mask)
+    return masks
+
+
+def best_time(function, masks, components, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(masks, components)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark angle sweep vs exact Feret diameter')
+    parser.add_argument('dir', nargs='?', default=con.base_volume_dir)
+    parser.add_argument('--volumes', type=int, default=20, help='number of volumes to use')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    angle_total = feret_total = 0
+    worst = 0
+    for volume_id in con.get_volumes(args.dir)[:args.volumes]:
+        volume_dir = f'{args.dir}/volume_{volume_id}'
+        masks = load_masks(volume_dir)
+        if not masks:
+            continue
+        components = con.analyze_components(masks)
+        angle_time, angle = best_time(con.max_tumor_diameter_by_angle, masks, components, args.repeat)
+        feret_time, feret = best_time(con.max_tumor_diameter_feret, masks, components, args.repeat)
+        angle_total += angle_time
+        feret_total += feret_time
+        # the sweep can only underestimate, by at most a factor cos(0.5 deg)
+        difference = (feret - angle) / feret if feret else 0
+        worst = max(worst, abs(difference))
+        print(f"volume_{volume_id}: angle {angle:.4f} ({angle_time * 1000:.1f} ms)  "
+              f"feret {feret:.4f} ({feret_time * 1000:.1f} ms)  diff {difference * 100:.4f}%")
+
+    if feret_total:
+        print(f"total: angle {angle_total:.3f} s, feret {feret_total:.3f} s, "
+              f"speedup {angle_total / feret_total:.1f}x, max relative difference {worst * 100:.4f}%")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+
+import get_conventional as con
+import synthetic_data
+import volume_store
+
+# Times every extraction stage on synthetic volumes and writes the results as JSON.
+#   python benchmark.py --out bench.json                        # measure
+#   python benchmark.py --out new.json --baseline bench.json    # measure and compare
+# With --baseline the run exits with status 1 when a stage is slower than the
+# baseline by more than --threshold (0.2 = 20%).
+
+
+def best_time(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def run_stages(directory, repeat, radiomics=True):
+    volume_dir = os.path.join(directory, 'volume_1')
+    paths = [path for _, path in volume_store.slice_files(volume_dir)]
+    images = []
+    masks = []
+    for path in paths:
+        image, mask = con.load_data(path)
+        if np.any(mask):
+            images.append(image)
+            masks.append(mask)
+
+    stages = {
+        'load_data': lambda: [con.load_data(path) for path in paths],
+        'max_tumor_area': lambda: con.max_tumor_area(masks),
+        'max_tumor_diameter_pca': lambda: con.max_tumor_diameter_pca(masks),
+        'max_tumor_diameter_simple': lambda: con.max_tumor_diameter_simple(masks),
+        'max_tumor_diameter_by_angle': lambda: con.max_tumor_diameter_by_angle(masks),
+        'outer_layer_involvement': lambda: con.outer_layer_involvement(images, masks),
+        'process_volume': lambda: con.process_volume(volume_dir),
+    }
+    if radiomics:
+        import get_radiomics as radio
+        stages['get_all_radiomics'] = lambda: radio.get_all_radiomics(directory, use_cache=False)
+
+    results = {}
+    for name, function in stages.items():
+        results[name] = best_time(function, repeat)
+        print(f"{name:30s} {results[name] * 1000:10.1f} ms", file=sys.stderr)
+    return results
+
+
+# names of the stages that got slower than baseline * (1 + threshold)
+def regressions(results, baseline, threshold):
+    slower = []
+    for name, seconds in results.items():
+        if name in baseline and seconds > baseline[name] * (1 + threshold):
+            slower.append(name)
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the feature extraction stages on synthetic data')
+    parser.add_argument('--out', default='benchmark.json', help='where to write the results')
+    parser.add_argument('--baseline', help='results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown per stage')
+    parser.add_argument('--volumes', type=int, default=2)
+    parser.add_argument('--slices', type=int, default=155)
+    parser.add_argument('--radius', type=float, default=30, help='tumor radius in voxels')
+    parser.add_argument('--fragments', type=int, default=20, help='extra small tumor blobs per slice')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-radiomics', action='store_true', help='skip get_all_radiomics')
+    args = parser.parse_args()
+
+    config = {'volumes': args.volumes, 'slices': args.slices, 'radius': args.radius,
+              'fragments': args.fragments, 'repeat': args.repeat}
+    directory = tempfile.mkdtemp(prefix='cits4402_bench_')
+    try:
+        synthetic_data.make_cohort(directory, args.volumes, slices=args.slices,
+                                   tumor_radius=args.radius, fragments=args.fragments)
+        results = run_stages(directory, args.repeat, radiomics=not args.no_radiomics)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    with open(args.out, 'w') as file:
+        json.dump({'config': config, 'stages': results}, file, indent=2)
+    print("Results saved to:", args.out, file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        if baseline.get('config') != config:
+            print("Warning: baseline was run with a different configuration", file=sys.stderr)
+        for name, seconds in results.items():
+            if name in baseline['stages']:
+                ratio = seconds / baseline['stages'][name]
+                print(f"{name:30s} {ratio:6.2f}x baseline", file=sys.stderr)
+        slower = regressions(results, baseline['stages'], args.threshold)
+        if slower:
+            print("Regression in:", ', '.join(slower), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+import os
+import numpy as np
+import volume_store
+import manifest
+from feature_cache import volume_fingerprint
+
+# Whole cohort in memory, compact enough for one node, for experiments that
+# run the extractors many times (parameter sweeps).
+#   cohort = CompactCohort(directory)       # reads every volume once
+#   print(f"{cohort.nbytes() / 2**30:.1f} GiB")
+#   with cohort:
+#       con.get_all(directory, thickness=3)
+#       con.get_all(directory, thickness=7)   # no slice is read from disk
+# Per volume (CompactVolume):
+#   images  cropped to the box where any channel differs from its background
+#           (the value of the first voxel, kept per channel as fill), stored
+#           as the smallest integer type when the values are whole numbers,
+#           otherwise quantized to image_bits per channel with a recorded
+#           offset and scale (image_bits=None keeps the stored values as they are)
+#   masks   cropped to the tumor box and bit-packed (uint8 crop when a mask
+#           is not 0/1)
+# Nothing is decoded up front: while a cohort is active (with cohort: or
+# activate()), get_conventional.read_tumor_slices and get_radiomics.load_roi
+# decode its volumes into exactly the arrays they would have read. Worker
+# processes see the cohort when they are forked (Linux); with spawn they read
+# the files as before. A volume whose files changed since it was loaded is
+# read from disk again (lookup compares the file stats).
+# Quantized images give approximate features: while such a cohort is active
+# encoding() names it, and the extractors add it to their FeatureCache settings
+# and shared_cohort kinds, so those results never stand in for exact ones.
+
+
+# volume_dir -> CompactVolume of the active cohorts
+active = {}
+
+
+def box_shape(box):
+    return tuple(s.stop - s.start for s in box)
+
+
+# Box grown by margin voxels and clipped to shape, like volume_store.tumor_box
+def grow_box(box, margin, shape):
+    return tuple(slice(max(s.start - margin, 0), min(s.stop + margin, n)) for s, n in zip(box, shape))
+
+
+# box clipped to the part inside inner, and where that part goes in an array of box
+def overlap(box, inner):
+    clipped = tuple(slice(max(s.start, i.start), min(s.stop, i.stop)) for s, i in zip(box, inner))
+    if any(s.start >= s.stop for s in clipped):
+        return None, None
+    source = tuple(slice(c.start - i.start, c.stop - i.start) for c, i in zip(clipped, inner))
+    target = tuple(slice(c.start - s.start, c.stop - s.start) for c, s in zip(clipped, box))
+    return source, target
+
+
+# (stored, offset, scale) of a crop (z, y, x, channels): stored values,
+# offset + stored * scale gives the image back (per channel); offset and
+# scale are None when stored holds the values themselves
+def encode_image(crop, image_bits):
+    if not crop.size:
+        return crop, None, None
+    channels = crop.shape[-1]
+    low = crop.reshape(-1, channels).min(axis=0)
+    high = crop.reshape(-1, channels).max(axis=0)
+    if crop.dtype.kind in 'iu' or np.array_equal(crop, np.round(crop)):
+        dtype = np.promote_types(np.min_scalar_type(int(low.min())), np.min_scalar_type(int(high.max())))
+        return crop.astype(dtype), None, None
+    if image_bits is None:
+        return crop, None, None
+    scale = np.where(high > low, (high - low) / (2 ** image_bits - 1), 1)
+    dtype = np.uint8 if image_bits <= 8 else np.uint16
+    return np.round((crop - low) / scale).astype(dtype), low, scale
+
+
+# One volume, encoded as described at the top
+class CompactVolume:
+    def __init__(self, volume_dir, image_bits=16):
+        self.volume_dir = volume_dir
+        self.image_bits = image_bits
+        self.fingerprint = volume_fingerprint(volume_dir)
+        images, masks = volume_store.read_volume(volume_dir)
+        self.shape = images.shape[:3]
+        self.image_dtype = images.dtype
+        self.mask_dtype = masks.dtype
+        self.mask_channels = masks.shape[-1]
+
+        self.fill = images[0, 0, 0].copy()
+        self.image_box = volume_store.mask_box(np.any(images != self.fill, axis=-1))
+        self.images, self.offset, self.scale = encode_image(images[self.image_box], image_bits)
+        del images
+
+        tumor = masks.reshape(masks.shape[:3] + (-1,)).any(axis=-1)
+        self.tumor = tumor.any(axis=(1, 2))
+        # an empty mask gives the whole volume as box, like tumor_box
+        self.mask_box = volume_store.mask_box(tumor)
+        crop = masks[self.mask_box]
+        self.binary = crop.size == 0 or crop.max() <= 1
+        self.masks = np.packbits(crop.astype(bool)) if self.binary else np.ascontiguousarray(crop)
+
+    def nbytes(self):
+        return self.images.nbytes + self.masks.nbytes + self.tumor.nbytes
+
+    # True when decode_images only gives the values back approximately
+    def lossy(self):
+        return self.scale is not None
+
+    # image channel(s) inside box (the whole volume by default) as dtype;
+    # channel=None gives (z, y, x, channels)
+    def decode_images(self, box=None, channel=None, dtype=None):
+        box = tuple(slice(0, n) for n in self.shape) if box is None else box
+        dtype = self.image_dtype if dtype is None else dtype
+        channels = slice(None) if channel is None else channel
+        out = np.empty(box_shape(box) + np.shape(self.fill[channels]), dtype=dtype)
+        out[...] = self.fill[channels]
+        source, target = overlap(box, self.image_box)
+        if source is not None:
+            stored = self.images[source + (channels,)]
+            out[target] = stored if self.scale is None else stored * self.scale[channels] + self.offset[channels]
+        return out
+
+    # mask channels (z, y, x, channels) inside box
+    def decode_masks(self, box=None):
+        box = tuple(slice(0, n) for n in self.shape) if box is None else box
+        out = np.zeros(box_shape(box) + (self.mask_channels,), dtype=self.mask_dtype)
+        source, target = overlap(box, self.mask_box)
+        if source is not None:
+            if self.binary:
+                shape = box_shape(self.mask_box) + (self.mask_channels,)
+                crop = np.unpackbits(self.masks, count=int(np.prod(shape))).reshape(shape)
+            else:
+                crop = self.masks
+            out[target] = crop[source]
+        return out
+
+    # what get_conventional.read_tumor_slices returns: the full frames of the
+    # slices with tumor, (n, H, W, channels) images and (n, H, W, 3) masks
+    def tumor_slices(self):
+        indices = np.flatnonzero(self.tumor)
+        if not len(indices):
+            return {'images': np.zeros(0), 'masks': np.zeros(0, dtype=np.uint8), 'slices': np.array(self.shape[0])}
+        box = (slice(int(indices[0]), int(indices[-1]) + 1), slice(0, self.shape[1]), slice(0, self.shape[2]))
+        keep = indices - indices[0]
+        return {'images': self.decode_images(box)[keep], 'masks': self.decode_masks(box)[keep],
+                'slices': np.array(self.shape[0])}
+
+    # what get_radiomics.load_roi returns: channel 0 as float32 and the summed
+    # masks (plus the mask channels with regions=True) in the tumor box grown by margin
+    def roi(self, margin, regions=False):
+        box = tuple(slice(0, n) for n in self.shape)
+        if margin is not None:
+            box = grow_box(self.mask_box, margin, self.shape) if self.tumor.any() else box
+        channels = self.decode_masks(box)
+        arrays = {'images': self.decode_images(box, channel=0, dtype=np.float32),
+                  'masks': channels.sum(axis=-1, dtype=np.uint8)}
+        if regions:
+            arrays['channels'] = channels
+        return arrays
+
+
+# The CompactVolumes of the volume_N directories of directory (or of the
+# given volume numbers). progress(done, total) is called after every volume.
+class CompactCohort:
+    def __init__(self, directory, volumes=None, image_bits=16, progress=None):
+        if volumes is None:
+            volumes = manifest.volume_numbers(directory)
+        self.volumes = {}
+        for done, number in enumerate(sorted(volumes), 1):
+            volume_dir = os.path.join(directory, f'volume_{number}')
+            self.volumes[os.path.abspath(volume_dir)] = CompactVolume(volume_dir, image_bits)
+            if progress is not None:
+                progress(done, len(volumes))
+
+    def nbytes(self):
+        return sum(volume.nbytes() for volume in self.volumes.values())
+
+    def activate(self):
+        active.update(self.volumes)
+
+    def deactivate(self):
+        for volume_dir, volume in self.volumes.items():
+            if active.get(volume_dir) is volume:
+                del active[volume_dir]
+
+    def __enter__(self):
+        self.activate()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.deactivate()
+
+
+# CompactVolume of volume_dir in an active cohort, None when there is none or
+# its files changed
+def lookup(volume_dir):
+    if not active:
+        return None
+    volume = active.get(os.path.abspath(volume_dir))
+    if volume is None or volume.fingerprint != volume_fingerprint(volume_dir):
+        return None
+    return volume
+
+
+# None while every active volume decodes to the values on disk, otherwise the
+# lossy encoding of the active cohorts ('16bit')
+def encoding():
+    bits = sorted({volume.image_bits for volume in active.values() if volume.lossy()})
+    return '_'.join(f'{b}bit' for b in bits) or None
+
+
+# name (a cache or shared memory kind) for data read with encoding
+def tagged(name, encoding):
+    return name if encoding is None else f'{name}_{encoding}'
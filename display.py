@@ -0,0 +1,94 @@
+import threading
+import numpy as np
+import volume_store
+import manifest
+
+# Display pipeline for the viewer.
+# Every slice is converted once, when it is loaded, into
+#   channels - (channels, H, W) uint8, normalised with the value range of the
+#              whole volume (so frames do not flicker while scrolling) and
+#              already rotated 90 degrees counterclockwise
+#   overlay  - (H, W) bool, any tumor label, same orientation
+# After that a frame is an index into channels plus, with annotation on, one
+# lookup into BLEND.
+
+# BLEND[value] is the plain grey pixel, BLEND[256 + value] the same pixel
+# blended 50% with yellow
+grey = np.arange(256, dtype=np.uint16)
+BLEND = np.concatenate([
+    np.stack([grey, grey, grey], axis=-1),
+    np.stack([(grey + 255) // 2, (grey + 255) // 2, grey // 2], axis=-1),
+]).astype(np.uint8)
+
+
+def to_display(image, mask, channel_min, channel_max):
+    scale = np.maximum(channel_max - channel_min, np.finfo(np.float64).tiny)
+    normalized = (image - channel_min) / scale
+    channels = (255 * normalized).astype(np.uint8).transpose(2, 0, 1)
+    overlay = np.any(mask, axis=-1)
+    # rot90 turns counterclockwise like PIL's rotate(90, expand=True)
+    return np.ascontiguousarray(np.rot90(channels, axes=(1, 2))), np.ascontiguousarray(np.rot90(overlay))
+
+
+def render(channels, overlay, channel_id, annotate=False):
+    frame = channels[channel_id]
+    if not annotate:
+        return frame
+    return BLEND[frame + (overlay.astype(np.uint16) << 8)]
+
+
+# Loader for SliceCache: reads a slice and returns it display ready.
+# The per volume ranges come from packed.h5 or the manifest. A volume that has
+# none yet (not packed, never viewed) would have to read every slice before
+# its first frame, so its frames use their own range meanwhile and a thread
+# computes the volume's (manifest.channel_ranges, kept for the next session).
+# on_ranges(volume_dir) is called from that thread once they are in: frames
+# loaded before are stale (SliceCache.reload).
+class DisplayLoader:
+    def __init__(self, on_ranges=None):
+        self.on_ranges = on_ranges
+        self.ranges = {}
+        self.computing = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, volume_dir, slice_id):
+        ranges = self.volume_ranges(volume_dir)
+        image, mask = volume_store.read_slice(volume_dir, slice_id)
+        if ranges is None:
+            return to_display(image, mask, image.min(axis=(0, 1)), image.max(axis=(0, 1)))
+        return to_display(image, mask, *ranges)
+
+    # True while frames of volume_dir are drawn with their own range
+    def provisional(self, volume_dir):
+        with self.lock:
+            return volume_dir in self.computing
+
+    def volume_ranges(self, volume_dir):
+        with self.lock:
+            if volume_dir in self.ranges:
+                return self.ranges[volume_dir]
+            if volume_dir in self.computing:
+                return None
+        ranges = volume_store.stored_ranges(volume_dir, manifest.volume_entry(volume_dir))
+        with self.lock:
+            if ranges is not None:
+                self.ranges = {volume_dir: ranges}
+                return ranges
+            self.computing.add(volume_dir)
+        threading.Thread(target=self.compute_ranges, args=(volume_dir,), daemon=True).start()
+        return None
+
+    def compute_ranges(self, volume_dir):
+        try:
+            ranges = manifest.channel_ranges(volume_dir)
+        except Exception as exception:
+            print("Could not compute the value range of", volume_dir, ":", exception)
+            ranges = None
+        with self.lock:
+            if ranges is not None:
+                self.ranges = {volume_dir: ranges}
+        if ranges is not None and self.on_ranges is not None:
+            self.on_ranges(volume_dir)
+        # cleared last: whoever sees provisional() False finds the reloaded cache
+        with self.lock:
+            self.computing.discard(volume_dir)
@@ -0,0 +1,56 @@
+import os
+import json
+import pickle
+import hashlib
+import volume_store
+
+# On-disk cache of per-volume features so an interrupted get_all /
+# get_all_radiomics run can resume, and re-selecting radiomic features does
+# not recompute anything that was already extracted.
+#
+# Entries live in <data dir>/.feature_cache/<kind>/<key>.pkl where key is a
+# hash of the volume's files (names, sizes, mtimes) and the extractor
+# settings, so a changed volume or changed settings never hits a stale entry.
+CACHE_DIR = '.feature_cache'
+
+
+# names, sizes and modification times of the files a volume is read from
+def volume_fingerprint(volume_dir):
+    if volume_store.is_packed(volume_dir):
+        paths = [volume_store.packed_path(volume_dir)]
+    else:
+        paths = [path for _, path in volume_store.slice_files(volume_dir)]
+    parts = []
+    for path in paths:
+        stat = os.stat(path)
+        parts.append(f'{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, directory, kind, settings):
+        self.path = os.path.join(directory, CACHE_DIR, kind)
+        os.makedirs(self.path, exist_ok=True)
+        self.settings = json.dumps(settings, sort_keys=True, default=str)
+
+    def key(self, volume_dir):
+        return hashlib.sha1((volume_fingerprint(volume_dir) + self.settings).encode()).hexdigest()
+
+    def entry_path(self, volume_dir):
+        return os.path.join(self.path, self.key(volume_dir) + '.pkl')
+
+    # (True, value) for a cached volume, (False, None) otherwise
+    def get(self, volume_dir):
+        path = self.entry_path(volume_dir)
+        if not os.path.exists(path):
+            return False, None
+        with open(path, 'rb') as file:
+            return True, pickle.load(file)
+
+    # written to a temporary file first, a crash never leaves a broken entry
+    def put(self, volume_dir, value):
+        path = self.entry_path(volume_dir)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(value, file)
+        os.replace(tmp_path, path)
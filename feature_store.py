@@ -0,0 +1,180 @@
+import os
+import re
+import csv
+import numbers
+import h5py
+import numpy as np
+
+# Output sinks for the feature extractors. Both take one record (dict of
+# feature name -> value) per volume through add() and write on close(),
+# into a temporary file that is renamed at the end.
+#   CSVSink          - the selected columns as a csv (the files used so far)
+#   HDF5FeatureSink  - every feature, one typed dataset per column, appended in
+#                      batches; read back single columns with read_features()
+# output_formats maps the names accepted by get_all / get_all_radiomics to sinks.
+# merge_csv / merge_hdf5 put the partial outputs of sharded runs back together.
+
+
+class CSVSink:
+    def __init__(self, path, columns, header=None):
+        self.path = path
+        self.columns = columns
+        self.tmp_path = path + '.tmp'
+        self.file = open(self.tmp_path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header if header is not None else columns)
+
+    def add(self, record):
+        self.writer.writerow([record[column] for column in self.columns])
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+# numbers become float64 columns (NaN where a volume has no value), anything
+# else is stored as text
+def column_dtype(value):
+    if isinstance(value, (numbers.Number, np.number)) or (isinstance(value, np.ndarray) and value.ndim == 0
+                                                           and np.issubdtype(value.dtype, np.number)):
+        return np.float64
+    return h5py.string_dtype()
+
+
+def column_value(value, dtype):
+    if value is None:
+        return np.nan if dtype == np.float64 else ''
+    if dtype == np.float64:
+        return float(value)
+    return value if isinstance(value, str) else str(value)
+
+
+class HDF5FeatureSink:
+    def __init__(self, path, batch_size=64):
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.batch_size = batch_size
+        self.file = h5py.File(self.tmp_path, 'w')
+        self.group = self.file.create_group('features')
+        self.columns = []
+        self.buffer = []
+        self.rows = 0
+
+    def add(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        for record in self.buffer:
+            for name, value in record.items():
+                if name not in self.columns:
+                    self.columns.append(name)
+                # a column is typed by its first value that is not None (a
+                # missing feature says nothing about the type), earlier rows
+                # of a column that shows up late are NaN / ''
+                if value is not None and name not in self.group:
+                    self.create_column(name, column_dtype(value))
+        n = len(self.buffer)
+        for name in self.columns:
+            if name not in self.group:
+                continue  # only None so far, the rows are filled in when it is created
+            dataset = self.group[name]
+            numeric = dataset.dtype == np.float64
+            values = [column_value(record.get(name), np.float64 if numeric else str) for record in self.buffer]
+            dataset.resize((self.rows + n,))
+            dataset[self.rows:] = np.array(values, dtype=np.float64 if numeric else object)
+        self.rows += n
+        self.buffer = []
+
+    def create_column(self, name, dtype):
+        fill = {'fillvalue': np.nan} if dtype == np.float64 else {}
+        self.group.create_dataset(name, shape=(self.rows,), dtype=dtype, maxshape=(None,), chunks=(1024,), **fill)
+
+    def close(self):
+        self.flush()
+        # columns without any value are numeric, all NaN
+        for name in self.columns:
+            if name not in self.group:
+                self.create_column(name, np.float64)
+        self.group.attrs['columns'] = self.columns
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+# {column: array} for the wanted columns only (all of them when columns is None)
+def read_features(path, columns=None):
+    with h5py.File(path, 'r') as file:
+        group = file['features']
+        if columns is None:
+            columns = list(group.attrs['columns'])
+        result = {}
+        for name in columns:
+            dataset = group[name]
+            result[name] = dataset.asstr()[()] if h5py.check_string_dtype(dataset.dtype) else dataset[()]
+        return result
+
+
+output_formats = {'csv': CSVSink, 'hdf5': HDF5FeatureSink}
+
+
+# sinks for one run: csv_path gets the csv columns, the table goes next to it
+def open_sinks(csv_path, columns, header=None, formats=('csv', 'hdf5')):
+    sinks = []
+    for name in formats:
+        if name == 'csv':
+            sinks.append(CSVSink(csv_path, columns, header))
+        else:
+            sinks.append(output_formats[name](csv_path[:-len('.csv')] + '.h5'))
+    return sinks
+
+
+# sort key for the first column, '12' (conventional) or 'volume_12' (radiomics)
+def volume_number(volume_id):
+    return int(re.search(r'\d+', str(volume_id)).group())
+
+
+# rows of several partial csvs (same header) in volume order, one csv
+def merge_csv(paths, out_path):
+    header = None
+    rows = {}
+    for path in paths:
+        with open(path, newline='') as file:
+            reader = csv.reader(file)
+            partial_header = next(reader)
+            if header is None:
+                header = partial_header
+            elif partial_header != header:
+                raise ValueError(f"{path} has different columns than {paths[0]}")
+            for row in reader:
+                number = volume_number(row[0])
+                if number in rows:
+                    raise ValueError(f"volume {row[0]} is in more than one partial result")
+                rows[number] = row
+    sink = CSVSink(out_path, header)
+    for number in sorted(rows):
+        sink.add(dict(zip(header, rows[number])))
+    sink.close()
+    return len(rows)
+
+
+# rows of several partial feature tables in volume order, one table
+def merge_hdf5(paths, out_path):
+    records = {}
+    for path in paths:
+        features = read_features(path)
+        columns = list(features)
+        if not columns:
+            continue  # shard without any volume
+        for i in range(len(features[columns[0]])):
+            number = volume_number(features[columns[0]][i])
+            if number in records:
+                raise ValueError(f"volume {features[columns[0]][i]} is in more than one partial result")
+            records[number] = {name: features[name][i] for name in columns}
+    sink = HDF5FeatureSink(out_path)
+    for number in sorted(records):
+        sink.add(records[number])
+    sink.close()
+    return len(records)
@@ -1,10 +1,19 @@
-import csv
 import h5py
 import numpy as np
 import os
-from scipy.ndimage import label, binary_erosion
+from scipy.ndimage import label, binary_erosion, find_objects, distance_transform_cdt
 from numpy.linalg import svd
-import re
+from scipy.spatial import ConvexHull, QhullError
+import argparse
+from functools import partial
+import volume_store
+import manifest
+from feature_cache import FeatureCache
+from parallel import run_jobs
+from profiling import Profile, NULL_PROFILE, write_profile
+from feature_store import open_sinks, output_formats
+from shared_cohort import load_shared
+import compact_cohort
 
 # Define the base directory where all volumes are stored
 base_volume_dir = './test_dir'
@@ -13,30 +22,78 @@ def load_data(h5_path):
     with h5py.File(h5_path, 'r') as file:
         image = file['image'][:]
         mask = file['mask'][:]
-        if image.ndim == 4:  
-            image = np.mean(image, axis=-1)  # Convert to grayscale by averaging channels
-        if mask.ndim == 4:  
-            mask = mask[..., 0]  # Take the first channel assuming mask is binary
-    return image, mask
+    return adjust_data(image, mask)
 
-def max_tumor_area(masks):
-    return max(np.sum(mask) for mask in masks)
 
+def adjust_data(image, mask):
+    if image.ndim == 4:  
+        image = np.mean(image, axis=-1)  # Convert to grayscale by averaging channels
+    if mask.ndim == 4:  
+        mask = mask[..., 0]  # Take the first channel assuming mask is binary
+    return image, mask
 
-def max_tumor_diameter_pca(masks):
-    diameters = []
+# Label each slice once and keep what every metric needs:
+#   areas   - tumor area of every slice
+#   largest - pixel coordinates of the largest connected component of every
+#             slice that has one, in np.where order
+# Component sizes come from one bincount over the label image instead of a
+# labeled_mask == i comparison per component.
+def analyze_components(masks):
+    areas = []
+    largest = []
+    num_components = 0
     for mask in masks:
-        labeled_mask, num_features = label(mask)
-        if num_features == 0:
-            continue
-
-        # Identify the largest component
-        component_sizes = [np.sum(labeled_mask == i) for i in range(1, num_features + 1)]
-        largest_component_label = np.argmax(component_sizes) + 1
-        largest_component = labeled_mask == largest_component_label
-
-        # Extract positions of the largest component
-        positions = np.column_stack(np.where(largest_component))
+        areas.append(np.sum(mask))
+        positions, num_features = largest_component(mask)
+        num_components += num_features
+        if positions is not None:
+            largest.append(positions)
+    return {'areas': areas, 'largest': largest, 'num_components': num_components}
+
+
+# (pixel coordinates of the largest component or None, number of components)
+def largest_component(mask):
+    labeled_mask, num_features = label(mask)
+    if num_features == 0:
+        return None, 0
+    sizes = np.bincount(labeled_mask.ravel(), minlength=num_features + 1)
+    largest_component_label = np.argmax(sizes[1:]) + 1
+    # only look inside the bounding box of that component
+    box = find_objects(labeled_mask, max_label=largest_component_label)[-1]
+    positions = np.column_stack(np.where(labeled_mask[box] == largest_component_label))
+    return positions + np.array([s.start for s in box]), num_features
+
+
+# analyze_components for a stacked (slices, H, W[, 3]) array. Areas are one
+# reduction over the stack; labeling stays per slice because a single
+# label() call with a stacked structure is slower than one call per slice.
+# origin=(y, x) is where masks was cropped from the full frame, positions are
+# shifted back so every metric gives the same numbers as on the full frame.
+def analyze_components_stack(masks, origin=None):
+    areas = masks.reshape(len(masks), -1).sum(axis=1)
+    results = [largest_component(mask) for mask in masks]
+    largest = [positions for positions, _ in results if positions is not None]
+    if origin is not None:
+        shift = np.zeros(masks.ndim - 1, dtype=np.intp)
+        shift[:2] = origin
+        largest = [positions + shift for positions in largest]
+    return {'areas': list(areas), 'largest': largest,
+            'num_components': sum(num_features for _, num_features in results)}
+
+
+def max_tumor_area(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
+    return max(components['areas'])
+
+
+# Reference version of max_tumor_diameter_pca: one SVD per slice, every pixel
+# projected on the line of every axis.
+def max_tumor_diameter_pca_svd(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
+    diameters = []
+    for positions in components['largest']:
         if positions.shape[0] > 1:  # Ensure there are enough points for PCA
             mean_centered = positions - np.mean(positions, axis=0)
             _, s, vh = svd(mean_centered, full_matrices=False)
@@ -56,25 +113,117 @@ def max_tumor_diameter_pca(masks):
     return max(diameters) if diameters else 0
 
 
-def max_tumor_diameter_simple(masks):
+# Centroid and covariance of the pixel coordinates of every component in
+# largest, from raw moments (counts, sums and sums of products) summed for all
+# slices at once with reduceat instead of one SVD per slice. The moments of
+# integer coordinates are exact in int64 (n * sum(x*y) < 2**63 for anything up
+# to 240x240x155), so the covariance is rounded only once.
+# Returns counts (k,), means (k, d), covariances (k, d, d).
+def component_moments(largest):
+    counts = np.array([len(positions) for positions in largest], dtype=np.int64)
+    coordinates = np.ascontiguousarray(np.concatenate(largest).T, dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    sums = np.add.reduceat(coordinates, starts, axis=1)
+    d = len(coordinates)
+    covariances = np.empty((len(largest), d, d))
+    for i in range(d):
+        for j in range(i, d):
+            products = np.add.reduceat(coordinates[i] * coordinates[j], starts)
+            covariances[:, i, j] = covariances[:, j, i] = (counts * products - sums[i] * sums[j]) / counts ** 2
+    return counts, (sums / counts).T, covariances
+
+
+# moments of components['largest'], computed once and kept in components for
+# every metric that needs them
+def moments_of(components):
+    if 'moments' not in components:
+        components['moments'] = component_moments(components['largest'])
+    return components['moments']
+
+
+# Principal axes (k, d, d), one axis per column, of k covariance matrices.
+# 2x2 in closed form: the major axis is at angle 0.5 * atan2(2 c_rc, c_rr - c_cc)
+# from the row axis; larger d (rows, cols, mask channel) with a batched eigh.
+def principal_axes(covariances):
+    if covariances.shape[1] != 2:
+        return np.linalg.eigh(covariances)[1]
+    theta = 0.5 * np.arctan2(2 * covariances[:, 0, 1], covariances[:, 0, 0] - covariances[:, 1, 1])
+    cos, sin = np.cos(theta), np.sin(theta)
+    return np.stack([np.stack([cos, -sin], axis=-1), np.stack([sin, cos], axis=-1)], axis=1)
+
+
+# Same value as max_tumor_diameter_pca_svd: for every principal axis the
+# width of the component across that axis in the image plane, the largest
+# width over all axes and slices. Axes come from the moments. (For a round
+# component two axes have the same variance, any direction is a principal
+# axis there and the two versions can pick different ones.) A projection
+# peaks at the first or last pixel of a row (positions are row-major, like in
+# hull_points), so only those are projected, all slices in one go, and the
+# widths are per-component max - min with reduceat.
+def max_tumor_diameter_pca(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
+    if not components['largest']:
+        return 0
+    # single pixels (skipped by the SVD version) have width 0 on every axis
+    counts, _, covariances = moments_of(components)
+    axes = principal_axes(covariances)
+
+    # in-plane normal of every axis; an axis without in-plane part (along the
+    # mask channel) measures the column extent like the vertical case of the SVD version
+    row, col = axes[:, 0, :], axes[:, 1, :]
+    norm = np.hypot(row, col)
+    flat = norm < 1e-9
+    norm[flat] = 1
+    normal_row = np.where(flat, 0, col / norm)
+    normal_col = np.where(flat, 1, -row / norm)
+
+    points = np.concatenate(components['largest'])
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    first = np.ones(len(points), dtype=bool)
+    first[1:] = points[1:, 0] != points[:-1, 0]
+    first[starts] = True
+    last = np.roll(first, -1)
+    ends = np.flatnonzero(first | last)
+    component = np.repeat(np.arange(len(counts)), counts)[ends]
+
+    rows, cols = points[ends, 0], points[ends, 1]
+    projections = rows[:, None] * normal_row[component] + cols[:, None] * normal_col[component]
+    segments = np.flatnonzero(np.diff(component, prepend=-1))
+    widths = np.maximum.reduceat(projections, segments) - np.minimum.reduceat(projections, segments)
+    return np.max(widths)
+
+
+# Shape descriptors of the biggest component of the volume (the largest
+# component of the slice where it is biggest) from the same moments, in the
+# image plane: major/minor axis length (4 standard deviations, like
+# skimage regionprops), eccentricity and orientation of the major axis in
+# degrees from the column axis.
+def shape_descriptors(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
+    if not components['largest']:
+        return {'Major_Axis_Length': 0, 'Minor_Axis_Length': 0, 'Eccentricity': 0, 'Orientation': 0}
+    counts, _, covariances = moments_of(components)
+    i = np.argmax(counts)
+    c_rr, c_rc, c_cc = covariances[i, 0, 0], covariances[i, 0, 1], covariances[i, 1, 1]
+    spread = np.sqrt(((c_rr - c_cc) / 2) ** 2 + c_rc ** 2)
+    major = max((c_rr + c_cc) / 2 + spread, 0)
+    minor = max((c_rr + c_cc) / 2 - spread, 0)
+    return {
+        'Major_Axis_Length': 4 * np.sqrt(major),
+        'Minor_Axis_Length': 4 * np.sqrt(minor),
+        'Eccentricity': np.sqrt(1 - minor / major) if major > 0 else 0,
+        'Orientation': np.degrees(0.5 * np.arctan2(2 * c_rc, c_cc - c_rr)),
+    }
+
+
+def max_tumor_diameter_simple(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
     max_diameters = []
-    for mask in masks:
-        labeled_mask, num_features = label(mask)
-        if num_features == 0:
-            continue
-
-        # Find the largest connected component
-        max_component = None
-        max_size = 0
-        for i in range(1, num_features + 1):
-            component = (labeled_mask == i)
-            size = np.sum(component)
-            if size > max_size:
-                max_size = size
-                max_component = component
-
+    for positions in components['largest']:
         # Calculate the diameter of the largest component
-        positions = np.column_stack(np.where(max_component))
         x_min, x_max = positions[:, 1].min(), positions[:, 1].max()
         y_min, y_max = positions[:, 0].min(), positions[:, 0].max()
         max_diameters.append(max(x_max - x_min, y_max - y_min))
@@ -82,27 +231,11 @@ def max_tumor_diameter_simple(masks):
     return max(max_diameters) if max_diameters else 0
 
 
-
-
-
-def max_tumor_diameter_by_angle(masks):
+def max_tumor_diameter_by_angle(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
     max_diameters = []
-    for mask in masks:
-        labeled_mask, num_features = label(mask)
-        if num_features == 0:
-            continue
-
-        # Extract the largest component
-        max_component = None
-        max_size = 0
-        for i in range(1, num_features + 1):
-            component = (labeled_mask == i)
-            size = np.sum(component)
-            if size > max_size:
-                max_size = size
-                max_component = component
-
-        positions = np.column_stack(np.where(max_component))
+    for positions in components['largest']:
         max_diameter_for_mask = 0
         for angle in range(0, 180, 1):
             radians = np.radians(angle)
@@ -115,6 +248,39 @@ def max_tumor_diameter_by_angle(masks):
     return max(max_diameters) if max_diameters else 0
 
 
+# Candidate points for the convex hull of one component: only the first and
+# last pixel of every row can be hull vertices (positions are in row-major order).
+def hull_points(positions):
+    rows, cols = positions[:, 0], positions[:, 1]
+    change = np.flatnonzero(np.diff(rows))
+    ends = np.concatenate([[0], change, change + 1, [len(rows) - 1]])
+    points = np.unique(np.column_stack([rows[ends], cols[ends]]), axis=0)
+    if len(points) < 3:
+        return points
+    try:
+        return points[ConvexHull(points).vertices]
+    except QhullError:
+        # all points on one line, the ends (sorted order) are the diameter
+        return points[[0, -1]]
+
+
+# Exact maximum caliper (Feret) diameter of the largest component.
+# The hull vertices of all slices are padded to one (slices, n, 2) array and
+# the farthest vertex pair is found for every slice at once.
+def max_tumor_diameter_feret(masks, components=None):
+    if components is None:
+        components = analyze_components(masks)
+    hulls = [hull_points(positions) for positions in components['largest']]
+    if not hulls:
+        return 0
+    n = max(len(hull) for hull in hulls)
+    # pad with copies of the first vertex, they never change the farthest pair
+    padded = np.stack([np.concatenate([hull, np.repeat(hull[:1], n - len(hull), axis=0)]) for hull in hulls])
+    padded = padded.astype(np.float64)
+    diff = padded[:, :, None, :] - padded[:, None, :, :]
+    return np.sqrt(np.max(np.sum(diff ** 2, axis=-1)))
+
+
 def outer_layer_involvement(images, masks, thickness=5):
     involvements = []
     for image, mask in zip(images, masks):
@@ -143,51 +309,298 @@ def outer_layer_involvement(images, masks, thickness=5):
     return np.mean(involvements) * 100
 
 
-def process_volume(volume_dir, csv_writer):
-    filenames = sorted(os.listdir(volume_dir), key=lambda x: int(x.split('_')[-1].split('.')[0]))
-    # print(filenames)
+# Taxicab distance of every brain pixel to the nearest non-brain pixel
+# (pixels outside the image count as non-brain), 0 outside the brain.
+# binary_erosion(brain_mask, iterations=t) keeps exactly the pixels with
+# distance > t, so one map answers every thickness.
+def brain_distances(brain_masks):
+    distances = np.zeros(brain_masks.shape, dtype=np.int32)
+    for i, brain_mask in enumerate(brain_masks):
+        padded = np.pad(brain_mask, 1)
+        distances[i] = distance_transform_cdt(padded, metric='taxicab')[1:-1, 1:-1]
+    return distances
+
+
+# brain_distances of the brain masks (first channel above its mean) of stacked images
+def brain_distance_map(images):
+    if images.ndim == 4:
+        images = images[..., 0]
+    thresholds = np.array([np.mean(image) for image in images])
+    return brain_distances(images > thresholds[:, None, None])
+
+
+# outer_layer_involvement for stacked (slices, H, W[, channels]) arrays and
+# a list of rim thicknesses, returns one value per thickness.
+# distances (brain_distance_map of images) can be passed in when it is reused.
+def outer_layer_involvement_sweep(images, masks, thicknesses=(5,), distances=None):
+    if masks.ndim == 4:
+        masks = np.any(masks, axis=-1)
+    n = len(masks)
+    if distances is None:
+        distances = brain_distance_map(images)
+
+    results = []
+    for thickness in thicknesses:
+        outer_layer_masks = (distances > 0) & (distances <= thickness)
+        outer_counts = outer_layer_masks.reshape(n, -1).sum(axis=1)
+        overlap_counts = (outer_layer_masks & masks).reshape(n, -1).sum(axis=1)
+        involvements = overlap_counts / np.maximum(outer_counts, 1)
+        involvements[outer_counts == 0] = 0
+        results.append(np.mean(involvements) * 100)
+    return results
+
+
+# diameter_method picks the function behind the Max_Tumor_Diameter column,
+# thickness is the outer layer rim width or a list of widths (one column each)
+diameter_methods = {
+    'angle': max_tumor_diameter_by_angle,
+    'feret': max_tumor_diameter_feret,
+    'pca': max_tumor_diameter_pca,
+    'simple': max_tumor_diameter_simple,
+}
+
+
+# csv column(s) for the outer layer, a list of thicknesses gives one
+# Avg_Outer_Layer_Involvement_<t> column each
+def involvement_columns(thickness):
+    if isinstance(thickness, (list, tuple)):
+        return [f"Avg_Outer_Layer_Involvement_{t}" for t in thickness]
+    return ["Avg_Outer_Layer_Involvement"]
+
+
+# The slices of a volume that have tumor, stacked:
+# {'images': (n, H, W, channels), 'masks': (n, H, W, 3), 'slices': slices in the volume}.
+# packed.h5 if the volume was packed, otherwise the per-slice files;
+# images are only read for slices that have tumor in their mask, and with
+# a manifest entry the slices without tumor are not opened at all
+def read_tumor_slices(volume_dir):
+    # decoded from memory while a compact cohort holds the volume (see compact_cohort.py)
+    compact = compact_cohort.lookup(volume_dir)
+    if compact is not None:
+        return compact.tumor_slices()
     masks = []
     images = []
-    for filename in filenames:
-        if filename.endswith('.h5'):
-            image, mask = load_data(os.path.join(volume_dir, filename))
-            if np.any(mask):  # Only consider non-zero slices
-                masks.append(mask)
-                images.append(image)
-
-    if masks:
-        max_area = max_tumor_area(masks)
-        max_diameter_pca = max_tumor_diameter_pca(masks)
-        max_diameter_simple = max_tumor_diameter_simple(masks)
-        max_diameter_angle = max_tumor_diameter_by_angle(masks)
-        avg_involvement = outer_layer_involvement(images, masks)
-
+    stats = {}
+    entry = manifest.volume_entry(volume_dir)
+    for image, mask in volume_store.iter_tumor_slices(volume_dir, stats, entry):
+        image, mask = adjust_data(image, mask)
+        if np.any(mask):  # Only consider non-zero slices
+            masks.append(mask)
+            images.append(image)
+    if not masks:
+        return {'images': np.zeros(0), 'masks': np.zeros(0, dtype=np.uint8), 'slices': np.array(stats.get('slices', 0))}
+    return {'images': np.stack(images), 'masks': np.stack(masks), 'slices': np.array(stats.get('slices', 0))}
+
+
+# metric names of region_features, the columns are <name>_<region>
+def region_columns(thickness):
+    return ["Max_Tumor_Area", "Max_Tumor_Diameter", "Max_Tumor_Diameter_PCA", "Max_Tumor_Diameter_Simple",
+            "Num_Components"] + involvement_columns(thickness)
+
+
+# The metrics of one subregion (a single mask channel, (slices, H, W)) as a
+# run with only that channel as the mask would give them: slices without the
+# region are left out and components are labeled in 2D. The decoded slices,
+# the tumor box and the brain distance map of the whole tumor are reused.
+def region_features(region_masks, box, distances, diameter_method, thicknesses):
+    present = region_masks.reshape(len(region_masks), -1).any(axis=1)
+    if not present.any():
+        return [0, 0, 0, 0, 0] + [0] * len(thicknesses)
+    region_masks = region_masks[present]
+    components = analyze_components_stack(region_masks[:, box[1], box[2]], origin=(box[1].start, box[2].start))
+    return [max_tumor_area(region_masks, components),
+            diameter_methods[diameter_method](region_masks, components),
+            max_tumor_diameter_pca(region_masks, components),
+            max_tumor_diameter_simple(region_masks, components),
+            components['num_components']] + \
+        outer_layer_involvement_sweep(None, region_masks, thicknesses, distances[present])
+
+
+# Every metric of one volume as {column: value} (None if the volume has no tumor).
+# This is what goes into the feature table, the csv only takes some of the columns.
+# The non-empty slices are stacked once and the metrics run on the stack,
+# analyze_components/outer_layer_involvement are the per-slice reference versions.
+def volume_features(volume_dir, diameter_method='angle', thickness=5, profile=NULL_PROFILE, shared=False,
+                    regions=False, encoding=None):
+    # shared=True takes the decoded slices from shared memory (see shared_cohort.py),
+    # encoding is compact_cohort.encoding() of the run, part of the segment name
+    # regions=True adds every metric per mask channel (see region_features)
+    with profile.stage('read'):
+        if shared:
+            arrays = load_shared(volume_dir, compact_cohort.tagged('tumor_slices', encoding),
+                                 partial(read_tumor_slices, volume_dir))
+        else:
+            arrays = read_tumor_slices(volume_dir)
+    images, masks = arrays['images'], arrays['masks']
+    profile.count('slices_read', arrays['slices'])
+    profile.count('nonempty_slices', len(masks))
+
+    if not len(masks):
+        return None
+    # The area/diameter metrics only look at the tumor, so they run on the
+    # tumor box (all components lie inside it, margin 0 is enough).
+    # The outer layer stays on full frames: its threshold and rim size are
+    # whole-brain quantities.
+    with profile.stage('crop'):
+        box = volume_store.mask_box(masks.reshape(masks.shape[:3] + (-1,)).any(axis=-1))
+        roi = masks[:, box[1], box[2]]
+    profile.count('roi_pixels', roi.shape[1] * roi.shape[2])
+    # label every slice once, all area/diameter metrics share the result
+    with profile.stage('components'):
+        components = analyze_components_stack(roi, origin=(box[1].start, box[2].start))
+    profile.count('components', components['num_components'])
+    with profile.stage('area'):
+        max_area = max_tumor_area(roi, components)
+    with profile.stage('diameter_pca'):
+        max_diameter_pca = max_tumor_diameter_pca(roi, components)
+        shape = shape_descriptors(roi, components)  # same moments as the PCA diameter
+    with profile.stage('diameter_simple'):
+        max_diameter_simple = max_tumor_diameter_simple(roi, components)
+    with profile.stage(f'diameter_{diameter_method}'):
+        max_diameter = diameter_methods[diameter_method](roi, components)
+    thicknesses = thickness if isinstance(thickness, (list, tuple)) else [thickness]
+    with profile.stage('outer_layer'):
+        distances = brain_distance_map(images)
+        avg_involvements = outer_layer_involvement_sweep(images, masks, thicknesses, distances)
+
+    features = {
+        'Volume_ID': volume_dir.split('_')[-1],
+        'Max_Tumor_Area': max_area,
+        'Max_Tumor_Diameter': max_diameter,
+        'Max_Tumor_Diameter_PCA': max_diameter_pca,
+        'Max_Tumor_Diameter_Simple': max_diameter_simple,
+        'Nonempty_Slices': len(masks),
+        'Num_Components': components['num_components'],
+    }
+    features.update(shape)
+    features.update(zip(involvement_columns(thickness), avg_involvements))
+    if regions and masks.ndim == 4:
+        with profile.stage('regions'):
+            for region, channel in volume_store.mask_regions.items():
+                region_values = region_features(masks[..., channel], box, distances, diameter_method, thicknesses)
+                features.update((f'{column}_{region}', value) for column, value
+                                in zip(region_columns(thickness), region_values))
+    #  print(f"Processed {volume_dir}: Max Area {max_area}, Max Diameter PCA {max_diameter_pca}, Max Diameter Simple {max_diameter_simple}, Avg Involvement {avg_involvement:.2f}%")
+    print(f"Processed {volume_dir}: Max Diameter PCA {max_diameter_pca}, Max Diameter Simple {max_diameter_simple}, Max Diameter ({diameter_method}) {max_diameter}")
+    return features
+
+
+# Returns the csv row for one volume (None if the volume has no tumor).
+# The row is only written here when a csv_writer is given.
+def process_volume(volume_dir, csv_writer=None, diameter_method='angle', thickness=5, profile=NULL_PROFILE):
+    features = volume_features(volume_dir, diameter_method, thickness, profile)
+    if features is None:
+        return None
+    row = [features[column] for column in ["Volume_ID", "Max_Tumor_Area", "Max_Tumor_Diameter"]
+           + involvement_columns(thickness)]
+    if csv_writer is not None:
+        csv_writer.writerow(row)
+    return row
+
+
+# volume_features with a fresh Profile, returns (features, profile record) so the
+# numbers can come back from a worker process
+def profile_volume(volume_dir, **kwargs):
+    profile = Profile(os.path.basename(volume_dir))
+    with profile.stage('total'):
+        features = volume_features(volume_dir, profile=profile, **kwargs)
+    return features, profile.record()
 
-        csv_writer.writerow([volume_dir.split('_')[-1], max_area, max_diameter_angle, avg_involvement])
-        #  print(f"Processed {volume_dir}: Max Area {max_area}, Max Diameter PCA {max_diameter_pca}, Max Diameter Simple {max_diameter_simple}, Avg Involvement {avg_involvement:.2f}%")
-        print(f"Processed {volume_dir}: Max Diameter PCA {max_diameter_pca}, Max Diameter Simple {max_diameter_simple}, Max Diameter Angle {max_diameter_angle}")
 
+def get_volumes(directory=base_volume_dir):
+    # from the manifest (see manifest.py), only new or changed volumes are scanned
+    return manifest.volume_numbers(directory)
 
 
-def get_volumes(directory=base_volume_dir):
-    items = os.listdir(directory)
-    volume_numbers = [int(re.search(r'\d+', item).group()) for item in items if re.search(r'\d+', item)]
-    return sorted(volume_numbers)
+# bump when a change to the metrics should invalidate cached rows
+cache_version = 3
 
 
 # get all volomes's features on dir
-def get_all(dir=base_volume_dir):
+# workers > 1 spreads the volumes over a process pool (workers <= 0 uses every core).
+# Rows are written in volume order either way, so the csv is identical to a serial run.
+# With use_cache every finished volume is stored in <dir>/.feature_cache, a rerun
+# (e.g. after a crash) only processes volumes that changed or were never finished.
+# formats picks the outputs (feature_store.output_formats): the csv keeps the
+# columns it always had, 'hdf5' also writes every metric of every volume to
+# conventional_features.h5 as one column per metric.
+# Outputs are written to a temporary file and renamed once all rows are there.
+# progress(done, total) is called after every volume; setting the cancel event
+# stops the run with parallel.Cancelled (finished volumes stay cached).
+# profile=True records time, CPU time, peak memory and counters per stage and
+# per processed volume in conventional_features_profile.json next to the csv.
+# With a shared_cohort.SharedCohort the decoded slices are kept in shared
+# memory, later runs with the same cohort (other thickness, other diameter
+# method) attach them instead of reading the volumes again.
+# volumes (volume numbers) and csv_file restrict the run to part of the cohort
+# and write its results elsewhere, batch.py uses them for sharded runs.
+# regions=True adds area, diameter and involvement columns for every mask
+# channel (<column>_NCR, _ED, _ET) to the same row, from the same read.
+# mp_context is handed to the process pool (parallel.map_volumes).
+def get_all(dir=base_volume_dir, workers=1, diameter_method='angle', thickness=5, use_cache=True,
+            progress=None, cancel=None, profile=False, formats=('csv', 'hdf5'), cohort=None,
+            volumes=None, csv_file=None, regions=False, mp_context=None):
     # csv_file = "conventional_features.csv"
-    csv_file = os.path.join(dir , 'conventional_features.csv')
-    volume_id_list=get_volumes(dir)
-    with open(csv_file, 'w', newline='') as file:
-        writer = csv.writer(file)
-        writer.writerow(["Volume_ID", "Max_Tumor_Area", "Max_Tumor_Diameter",  "Avg_Outer_Layer_Involvement"])
-        for i in volume_id_list: 
-            # volume_path = os.path.join(base_volume_dir, f'volume_{i}')
-            volume_path = os.path.join(dir, f'volume_{i}')
-            process_volume(volume_path, writer)
-    print("Data processing complete. Results saved to:", csv_file)
+    if csv_file is None:
+        csv_file = os.path.join(dir , 'conventional_features.csv')
+    volume_id_list=get_volumes(dir) if volumes is None else sorted(volumes)
+    # volume_path = os.path.join(base_volume_dir, f'volume_{i}')
+    volume_paths = [os.path.join(dir, f'volume_{i}') for i in volume_id_list]
+    # results from a quantized compact cohort are kept apart from exact ones
+    encoding = compact_cohort.encoding()
+    process = partial(profile_volume if profile else volume_features,
+                      diameter_method=diameter_method, thickness=thickness, shared=cohort is not None,
+                      regions=regions, encoding=encoding)
+    run_profile = Profile(dir) if profile else NULL_PROFILE
+    volume_records = []
+    features = {}
+    todo = volume_paths
+    cache = None
+    if use_cache:
+        settings = {'diameter_method': diameter_method, 'thickness': thickness, 'regions': regions,
+                    'version': cache_version}
+        if encoding is not None:
+            settings['encoding'] = encoding
+        cache = FeatureCache(dir, 'conventional', settings)
+        todo = []
+        with run_profile.stage('cache_lookup'):
+            for volume_path in volume_paths:
+                hit, volume = cache.get(volume_path)
+                if hit:
+                    features[volume_path] = volume
+                else:
+                    todo.append(volume_path)
+        print(f"{len(features)} volumes cached, {len(todo)} to process")
+    run_profile.count('volumes', len(volume_paths))
+    run_profile.count('volumes_cached', len(volume_paths) - len(todo))
+
+    if progress is not None:
+        progress(len(features), len(volume_paths))
+    # map keeps the input order no matter which worker finishes first
+    with run_profile.stage('process'):
+        for volume_path, volume in run_jobs(process, todo, todo, workers=workers, cancel=cancel, cohort=cohort,
+                                            kind=compact_cohort.tagged('tumor_slices', encoding),
+                                            records=volume_records if profile else None, progress=progress,
+                                            done=len(features), total=len(volume_paths), mp_context=mp_context):
+            features[volume_path] = volume
+            if cache is not None:
+                cache.put(volume_path, volume)
+
+    columns = ["Volume_ID", "Max_Tumor_Area", "Max_Tumor_Diameter"] + involvement_columns(thickness)
+    if regions:
+        columns += [f'{column}_{region}' for region in volume_store.mask_regions
+                    for column in ["Max_Tumor_Area", "Max_Tumor_Diameter"] + involvement_columns(thickness)]
+    with run_profile.stage('write'):
+        sinks = open_sinks(csv_file, columns, formats=formats)
+        for volume_path in volume_paths:
+            if features[volume_path] is not None:
+                for sink in sinks:
+                    sink.add(features[volume_path])
+        for sink in sinks:
+            sink.close()
+    print("Data processing complete. Results saved to:", ', '.join(sink.path for sink in sinks))
+    if profile:
+        print("Profile saved to:", write_profile(csv_file, run_profile, volume_records))
 
 
 #print(process_volume(volume_dir=base_volume_dir))
@@ -201,3 +614,21 @@ def get_all(dir=base_volume_dir):
 #         print(volume_path)
 #         process_volume(volume_path, writer)
 
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract conventional features for every volume in a directory')
+    parser.add_argument('dir', nargs='?', default=base_volume_dir)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 = all cores')
+    parser.add_argument('--diameter', choices=sorted(diameter_methods), default='angle',
+                        help='method used for Max_Tumor_Diameter')
+    parser.add_argument('--thickness', type=int, nargs='+',
+                        help='outer layer thickness(es), several values give one column each (default 5)')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every volume')
+    parser.add_argument('--profile', action='store_true', help='write per-stage timings next to the csv')
+    parser.add_argument('--formats', nargs='+', choices=sorted(output_formats), default=['csv', 'hdf5'],
+                        help='outputs to write (hdf5 holds every metric)')
+    parser.add_argument('--regions', action='store_true', help='also compute every metric per tumor subregion')
+    args = parser.parse_args()
+    get_all(args.dir, workers=args.workers, diameter_method=args.diameter,
+            thickness=args.thickness if args.thickness else 5, use_cache=not args.no_cache,
+            profile=args.profile, formats=args.formats, regions=args.regions)
@@ -2,12 +2,54 @@ import os
 import h5py
 import numpy as np
 import SimpleITK as sitk
-import csv
-import re
+import argparse
+from functools import partial
+import radiomics
 from radiomics import featureextractor
+import volume_store
+import manifest
+from feature_cache import FeatureCache
+from parallel import run_jobs
+from profiling import Profile, NULL_PROFILE, write_profile
+from feature_store import open_sinks, output_formats
+from shared_cohort import load_shared
+import compact_cohort
 
 # this directory is only for testing
 base_volume_dir = './test_dir'
+
+# features kept after feature selection (same list as MriApp.radiomic_feature_list)
+selected_features = ['original_shape_Sphericity',
+        'original_shape_SurfaceVolumeRatio',
+        'original_shape_Flatness',
+        'original_shape_Maximum3DDiameter',
+        'original_shape_Elongation',
+        'original_shape_LeastAxisLength',
+        'original_shape_Maximum2DDiameterSlice',
+        'original_shape_MajorAxisLength',
+        'original_shape_MeshVolume',
+        'original_shape_SurfaceArea',
+        'original_firstorder_Mean',
+        'original_firstorder_RootMeanSquared',
+        'original_firstorder_90Percentile',
+        'original_firstorder_Median',
+        'original_firstorder_InterquartileRange',
+        'original_firstorder_RobustMeanAbsoluteDeviation',
+        'original_firstorder_Maximum',
+        'original_firstorder_MeanAbsoluteDeviation',
+        'original_firstorder_Range',
+        'original_firstorder_10Percentile',
+        'original_glszm_GrayLevelNonUniformity',
+        'original_firstorder_Variance',
+        'original_glszm_ZonePercentage',
+        'original_glszm_SizeZoneNonUniformity',
+        'original_glszm_ZoneEntropy',
+        'original_gldm_DependenceNonUniformityNormalized',
+        'original_gldm_LargeDependenceEmphasis',
+        'original_gldm_DependenceEntropy',
+        'original_glszm_SizeZoneNonUniformityNormalized',
+        'original_glrlm_RunPercentage']
+
 def load_data(h5_path):
     with h5py.File(h5_path, 'r') as file:
         mask = file['mask'][:]    
@@ -17,23 +59,19 @@ def load_data(h5_path):
 
 # Load all data from the directory
 def load_3D(volume_dir):
+    # one read from packed.h5 when the volume has been packed
+    if volume_store.is_packed(volume_dir):
+        stacked_images, stacked_masks = volume_store.read_volume(volume_dir)
+        return stacked_images.astype(np.float32), stacked_masks
+
     all_masks = []
     all_images = []
-    
-    filenames = sorted(os.listdir(volume_dir), key=lambda x: int(x.split('_')[-1].split('.')[0]))
 
     # volume_dir
-    for filename in filenames:
-        # filename=volume_dir+"/"+filename
-        filename=os.path.join(volume_dir,filename)
-        #print(filename)
-        if filename.endswith('.h5'):
-            #print(filename)
-            # load
-            #image, mask = load_data(os.path.join(volume_dir, filename))
-            image, mask = load_data(filename)
-            all_masks.append(mask)
-            all_images.append(image)
+    for _, filename in volume_store.slice_files(volume_dir):
+        image, mask = load_data(filename)
+        all_masks.append(mask)
+        all_images.append(image)
 
     # put together
     stacked_masks = np.stack(all_masks)
@@ -42,10 +80,21 @@ def load_3D(volume_dir):
 
 
 # since stacked_masks.shape=(155, 240, 240, 3)，reduce dimension to  (155, 240, 240) by sum
-def load_and_adjust(volume_dir):
-    stacked_images,stacked_masks=load_3D(volume_dir)
-    stacked_images=stacked_images[:, :, :, 0]
-    sum_masks = np.sum(stacked_masks, axis=-1)
+# Only the wanted image channel is read (straight into one float32 array).
+# With margin set, images and masks are cut to the tumor bounding box grown by margin voxels;
+# with a manifest entry the box is known up front and only the box is read.
+def load_and_adjust(volume_dir, channel=0, margin=None):
+    entry = manifest.volume_entry(volume_dir)
+    box = None
+    if margin is not None and entry is not None:
+        box = volume_store.tumor_box(volume_dir, margin, entry)
+        sum_masks = volume_store.read_mask_sum(volume_dir, entry=entry, box=box)
+    else:
+        sum_masks = volume_store.read_mask_sum(volume_dir, entry=entry)
+        if margin is not None:
+            box = volume_store.mask_box(sum_masks, margin)
+            sum_masks = np.ascontiguousarray(sum_masks[box])
+    stacked_images = volume_store.read_image_channel(volume_dir, channel, box, entry=entry)
     return stacked_images,sum_masks
 
 
@@ -63,37 +112,225 @@ def get_radiomics(volume_dir=base_volume_dir):
 
 # Input parameter is a directory contains multi subfolders and return the volumes number as a list
 def get_volumes(directory=base_volume_dir):
-    items = os.listdir(directory)
-    print
-    # to get all the ids from the directory
-    volume_numbers = [int(re.search(r'\d+', item).group()) for item in items if re.search(r'\d+', item)]
-    return sorted(volume_numbers)
+    # from the manifest (see manifest.py), only new or changed volumes are scanned
+    return manifest.volume_numbers(directory)
 
 
 
 
-# col_list should be a list of top 10 features,this function gets all the readiomic features on directory
-def get_all_radiomics(directory=base_volume_dir, col_list=None):
+# {'shape': ['Sphericity', ...], 'firstorder': [...]} for the names in col_list
+# (names look like original_<class>_<feature>)
+def features_by_class(col_list):
+    enabled = {}
+    for name in col_list:
+        _, feature_class, feature_name = name.split('_', 2)
+        enabled.setdefault(feature_class, []).append(feature_name)
+    return enabled
+
+
+# Extractor that only computes the features in col_list, classes that are not
+# needed (glcm, ngtdm with the selected features) are never run.
+# col_list=None keeps the default extractor with every feature class enabled.
+def build_extractor(col_list=None):
     extractor = featureextractor.RadiomicsFeatureExtractor()
+    if col_list is not None:
+        extractor.disableAllFeatures()
+        extractor.enableFeaturesByName(**features_by_class(col_list))
+    return extractor
+
+
+# voxels kept around the tumor box; pyradiomics crops to the mask with the same
+# padding (padDistance) before any feature class runs, so the features do not
+# change, but the arrays read and converted to SimpleITK are much smaller
+roi_margin = 5
+
+
+# What extract_volume works on: {'images', 'masks'} from load_and_adjust, with
+# regions=True also 'channels' (the separate mask channels, same crop) read
+# in the same pass
+def load_roi(volume_dir, margin=roi_margin, regions=False):
+    # decoded from memory while a compact cohort holds the volume (see compact_cohort.py)
+    compact = compact_cohort.lookup(volume_dir)
+    if compact is not None:
+        return compact.roi(margin, regions)
+    if not regions:
+        stacked_images, sum_masks = load_and_adjust(volume_dir, margin=margin)
+        return {'images': stacked_images, 'masks': sum_masks}
+    entry = manifest.volume_entry(volume_dir)
+    box = volume_store.tumor_box(volume_dir, margin, entry) if margin is not None else None
+    channels = volume_store.read_masks(volume_dir, entry=entry, box=box)
+    return {'images': volume_store.read_image_channel(volume_dir, 0, box, entry=entry),
+            'masks': channels.sum(axis=-1, dtype=np.uint8), 'channels': channels}
+
+
+# name of the shared_cohort segment of load_roi(volume_dir, margin, regions),
+# encoding is compact_cohort.encoding() of the run
+def roi_kind(margin, regions, encoding=None):
+    return compact_cohort.tagged(f'regions_{margin}' if regions else f'roi_{margin}', encoding)
+
+
+# shared=True takes the cropped arrays from shared memory (see shared_cohort.py).
+# regions=True also extracts every feature per tumor subregion (<name>_NCR,
+# _ED, _ET; None where the volume has no such region), reusing the loaded
+# arrays and the SimpleITK image of the whole tumor run.
+def extract_volume(volume_dir, extractor, profile=NULL_PROFILE, margin=roi_margin, shared=False, regions=False,
+                   encoding=None):
+    with profile.stage('load'):
+        if shared:
+            arrays = load_shared(volume_dir, roi_kind(margin, regions, encoding),
+                                 partial(load_roi, volume_dir, margin, regions))
+        else:
+            arrays = load_roi(volume_dir, margin, regions)
+        stacked_images, stacked_masks = arrays['images'], arrays['masks']
+    profile.count('slices', len(stacked_masks))
+    profile.count('tumor_voxels', np.count_nonzero(stacked_masks))
+    with profile.stage('sitk'):
+        image, mask = sitk.GetImageFromArray(stacked_images,False), sitk.GetImageFromArray(stacked_masks,False)
+    with profile.stage('pyradiomics'):
+        features = extractor.execute(image, mask, label_channel=1)
+    if not regions:
+        return features
+
+    features = dict(features)
+    names = [name for name in features if not name.startswith('diagnostics_')]
+    for region, channel in volume_store.mask_regions.items():
+        with profile.stage(f'pyradiomics_{region}'):
+            region_mask = sitk.GetImageFromArray(np.ascontiguousarray(arrays['channels'][..., channel]), False)
+            try:
+                result = extractor.execute(image, region_mask)
+            except ValueError:
+                result = {}  # region missing (or too small) in this volume
+        features.update((f'{name}_{region}', result.get(name)) for name in names)
+    return features
+
+
+# each worker process builds one extractor per feature selection and reuses
+# it for all its volumes
+worker_extractors = {}
+
+
+# job = (volume_dir, feature names, regions), returns every feature the extractor computed
+def extract_job(job, profile=NULL_PROFILE, shared=False, encoding=None):
+    volume_dir, col_list, regions = job
+    key = tuple(col_list)
+    if key not in worker_extractors:
+        with profile.stage('build_extractor'):
+            worker_extractors[key] = build_extractor(col_list)
+    return dict(extract_volume(volume_dir, worker_extractors[key], profile, shared=shared, regions=regions,
+                               encoding=encoding))
+
+
+# extract_job with a fresh Profile, returns (features, profile record)
+def profile_job(job, shared=False, encoding=None):
+    profile = Profile(os.path.basename(job[0]))
+    with profile.stage('total'):
+        features = extract_job(job, profile, shared, encoding)
+    return features, profile.record()
+
+
+# Everything except the enabled features goes into the cache key, so entries
+# stay valid when col_list changes and only missing features are computed.
+def extractor_settings():
+    extractor = featureextractor.RadiomicsFeatureExtractor()
+    return {'settings': extractor.settings, 'image_types': extractor.enabledImagetypes,
+            'version': radiomics.__version__}
+
+
+# a feature name and, with regions, its per region columns
+def region_names(name, regions=False):
+    if not regions:
+        return [name]
+    return [name] + [f'{name}_{region}' for region in volume_store.mask_regions]
+
+
+# col_list should be a list of top 10 features,this function gets all the readiomic features on directory
+# workers > 1 runs the volumes in a process pool (workers <= 0 uses every core),
+# rows are still written in volume order.
+# With use_cache the features of every volume are kept in <directory>/.feature_cache:
+# a rerun skips finished volumes and a new col_list only computes the features
+# that were never extracted. The csv is written once all rows are there.
+# formats picks the outputs (feature_store.output_formats): the csv has the col_list
+# columns, 'hdf5' also writes every feature known for a volume (diagnostics
+# included) to radiomic_features.h5, one column per feature.
+# progress(done, total) is called after every volume; setting the cancel event
+# stops the run with parallel.Cancelled (finished volumes stay cached).
+# profile=True records time, CPU time, peak memory and counters per stage and
+# per extracted volume in radiomic_features_profile.json next to the csv.
+# With a shared_cohort.SharedCohort the cropped volumes are kept in shared memory,
+# later runs with the same cohort (e.g. a new col_list) do not read them again.
+# volumes (volume numbers) and csv_file_path restrict the run to part of the
+# cohort and write its results elsewhere, batch.py uses them for sharded runs.
+# regions=True adds every col_list feature per tumor subregion (<name>_NCR, _ED,
+# _ET) to the same row, from one read of the volume.
+# mp_context is handed to the process pool (parallel.map_volumes).
+def get_all_radiomics(directory=base_volume_dir, col_list=None, workers=1, use_cache=True,
+                      progress=None, cancel=None, profile=False, formats=('csv', 'hdf5'), cohort=None,
+                      volumes=None, csv_file_path=None, regions=False, mp_context=None):
+    if col_list is None:
+        col_list = selected_features
     # csv_file_path = base_volume_dir+'/radiomic_features.csv'
-    csv_file_path = os.path.join(directory , 'radiomic_features.csv')
-    id_list=get_volumes(directory)
-    with open(csv_file_path, mode='w', newline='') as csv_file:
-        
-        csv_writer = csv.writer(csv_file)
-        # head line for the csv file
-        feature_names = list(col_list)
-        csv_writer.writerow(['volume_id'] + feature_names)  
+    if csv_file_path is None:
+        csv_file_path = os.path.join(directory , 'radiomic_features.csv')
+    id_list=get_volumes(directory) if volumes is None else sorted(volumes)
+    #volume_dir = f'./archive/BraTS2020_training_data/content/data/volume_{volume_id}'
+    volume_dirs = [os.path.join(directory, f'volume_{volume_id}') for volume_id in id_list]
+    feature_names = list(col_list)
+
+    run_profile = Profile(directory) if profile else NULL_PROFILE
+    volume_records = []
+    # results from a quantized compact cohort are kept apart from exact ones
+    encoding = compact_cohort.encoding()
+    cache = None
+    if use_cache:
+        settings = extractor_settings()
+        if encoding is not None:
+            settings['encoding'] = encoding
+        cache = FeatureCache(directory, 'radiomics', settings)
+    features = {}
+    jobs = []
+    with run_profile.stage('cache_lookup'):
+        for volume_dir in volume_dirs:
+            entry = {}
+            if cache is not None:
+                _, entry = cache.get(volume_dir)
+                entry = entry or {}
+            features[volume_dir] = entry
+            missing = [name for name in feature_names
+                       if any(column not in entry for column in region_names(name, regions))]
+            if missing:
+                jobs.append((volume_dir, missing, regions))
+    print(f"{len(volume_dirs) - len(jobs)} volumes cached, {len(jobs)} to extract")
+    run_profile.count('volumes', len(volume_dirs))
+    run_profile.count('volumes_cached', len(volume_dirs) - len(jobs))
 
-        for volume_id in id_list:
-            #volume_dir = f'./archive/BraTS2020_training_data/content/data/volume_{volume_id}'
-            volume_dir = os.path.join(directory, f'volume_{volume_id}')
-            # load data
-            stacked_images, stacked_masks = load_and_adjust(volume_dir)
+    done = len(volume_dirs) - len(jobs)
+    if progress is not None:
+        progress(done, len(volume_dirs))
+    extract = partial(profile_job if profile else extract_job, shared=cohort is not None, encoding=encoding)
+    kind = roi_kind(roi_margin, regions, encoding)
+    with run_profile.stage('extract'):
+        for (volume_dir, _, _), new_features in run_jobs(
+                extract, jobs, [volume_dir for volume_dir, _, _ in jobs], workers=workers, cancel=cancel,
+                cohort=cohort, kind=kind, records=volume_records if profile else None,
+                progress=progress, done=done, total=len(volume_dirs), mp_context=mp_context):
+            features[volume_dir].update(new_features)
+            if cache is not None:
+                cache.put(volume_dir, features[volume_dir])
 
-            # features = extract_radiomics(sitk.GetImageFromArray(stacked_images, True), sitk.GetImageFromArray(stacked_masks, True))
-            features = extractor.execute(sitk.GetImageFromArray(stacked_images,False), sitk.GetImageFromArray(stacked_masks,False),label_channel=1)       
-            csv_writer.writerow([f'volume_{volume_id}'] + [features[feature_name] for feature_name in feature_names])
+    with run_profile.stage('write'):
+        columns = list(feature_names)
+        if regions:
+            # whole tumor first (the csv starts like a normal run), then one block per region
+            columns += [f'{name}_{region}' for region in volume_store.mask_regions for name in feature_names]
+        sinks = open_sinks(csv_file_path, ['volume_id'] + columns, formats=formats)
+        for volume_id, volume_dir in zip(id_list, volume_dirs):
+            record = {'volume_id': f'volume_{volume_id}', **features[volume_dir]}
+            for sink in sinks:
+                sink.add(record)
+        for sink in sinks:
+            sink.close()
+    if profile:
+        print("Profile saved to:", write_profile(csv_file_path, run_profile, volume_records))
 
 
 
@@ -133,4 +370,18 @@ def get_all_radiomics(directory=base_volume_dir, col_list=None):
 #         'original_gldm_DependenceEntropy',
 #         'original_glszm_SizeZoneNonUniformityNormalized',
 #         'original_glrlm_RunPercentage']
-# get_all_radiomics(directory="./test2", col_list=feature_names)
\ No newline at end of file
+# get_all_radiomics(directory="./test2", col_list=feature_names)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract the selected radiomic features for every volume in a directory')
+    parser.add_argument('dir', nargs='?', default=base_volume_dir)
+    parser.add_argument('--workers', type=int, default=1, help='worker processes, 0 = all cores')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every volume')
+    parser.add_argument('--profile', action='store_true', help='write per-stage timings next to the csv')
+    parser.add_argument('--formats', nargs='+', choices=sorted(output_formats), default=['csv', 'hdf5'],
+                        help='outputs to write (hdf5 holds every extracted feature)')
+    parser.add_argument('--regions', action='store_true', help='also extract every feature per tumor subregion')
+    args = parser.parse_args()
+    get_all_radiomics(args.dir, col_list=selected_features, workers=args.workers, use_cache=not args.no_cache,
+                      profile=args.profile, formats=args.formats, regions=args.regions)
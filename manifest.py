@@ -0,0 +1,178 @@
+import os
+import re
+import json
+import argparse
+import numpy as np
+import volume_store
+
+# Persistent index of a data directory. <dir>/manifest.json lists every
+# volume_N directory with its files (sizes, mtimes), shapes and dtypes and the
+# per-slice facts from volume_store.index_volume (tumor yes/no, tumor box),
+# so the loaders plan their reads without listing directories, parsing file
+# names or opening slices that have no tumor.
+# update_manifest() only indexes volumes that are new or whose files changed,
+# unchanged volumes are never read again.
+#   python manifest.py <dir>             # build / refresh
+#   python manifest.py <dir> --rebuild   # index every volume again
+MANIFEST_NAME = 'manifest.json'
+
+# bump when index_volume stores something new, older manifests are rebuilt
+manifest_version = 1
+
+volume_pattern = re.compile(r'volume_(\d+)$')
+
+
+def manifest_path(directory):
+    return os.path.join(directory, MANIFEST_NAME)
+
+
+def load_manifest(directory):
+    try:
+        with open(manifest_path(directory)) as file:
+            manifest = json.load(file)
+    except (OSError, ValueError):
+        manifest = None
+    if manifest is None or manifest.get('version') != manifest_version:
+        return {'version': manifest_version, 'volumes': {}}
+    return manifest
+
+
+# written to a temporary file first, a crash never leaves a broken manifest
+def save_manifest(directory, manifest):
+    path = manifest_path(directory)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file)
+    os.replace(tmp_path, path)
+
+
+# True while the volume still has the files that were indexed: the directory
+# mtime changes when files are added or removed, the file stats when one is rewritten
+def is_fresh(volume_dir, entry):
+    try:
+        if os.stat(volume_dir).st_mtime_ns != entry['dir_mtime_ns']:
+            return False
+        names = [name for name, _, _ in entry['files']]
+        return volume_store.file_stats(volume_dir, names) == [tuple(stat) for stat in entry['files']]
+    except OSError:
+        return False
+
+
+# {name: number} of the volume_N directories in directory
+def volume_dirs(directory):
+    found = {}
+    for item in os.listdir(directory):
+        match = volume_pattern.match(item)
+        if match and os.path.isdir(os.path.join(directory, item)):
+            found[item] = int(match.group(1))
+    return found
+
+
+# Bring <directory>/manifest.json up to date and return it,
+# rebuild=True indexes every volume again
+def update_manifest(directory, rebuild=False):
+    manifest = load_manifest(directory)
+    old = {} if rebuild else manifest['volumes']
+    volumes = {}
+    changed = rebuild
+    for name, number in sorted(volume_dirs(directory).items(), key=lambda item: item[1]):
+        volume_dir = os.path.join(directory, name)
+        entry = old.get(name)
+        if entry is None or not is_fresh(volume_dir, entry):
+            # stat before reading, a file changed during indexing makes the entry stale
+            dir_mtime_ns = os.stat(volume_dir).st_mtime_ns
+            entry = volume_store.index_volume(volume_dir)
+            if entry is None:
+                continue  # no slices (yet)
+            entry['number'] = number
+            entry['dir_mtime_ns'] = dir_mtime_ns
+            changed = True
+        volumes[name] = entry
+    if changed or volumes.keys() != manifest['volumes'].keys():
+        manifest['volumes'] = volumes
+        save_manifest(directory, manifest)
+    return manifest
+
+
+# After writing a file that is not read as slices (thumbnails.h5) into an
+# indexed volume: the entry is still right, only the directory mtime moved on.
+# Nothing happens when the indexed files changed as well.
+def touch_entry(volume_dir):
+    directory, name = os.path.split(os.path.normpath(volume_dir))
+    manifest = load_manifest(directory)
+    entry = manifest['volumes'].get(name)
+    if entry is None:
+        return
+    names = [name for name, _, _ in entry['files']]
+    try:
+        if not entry['packed'] and [os.path.basename(path) for _, path in volume_store.slice_files(volume_dir)] != names:
+            return
+        if volume_store.file_stats(volume_dir, names) != [tuple(stat) for stat in entry['files']]:
+            return
+        entry['dir_mtime_ns'] = os.stat(volume_dir).st_mtime_ns
+    except OSError:
+        return
+    save_manifest(directory, manifest)
+
+
+# Per channel (min, max) of a volume for display. Volumes without stored
+# ranges (not packed) are read slice by slice once, the result is kept in
+# their manifest entry for every later session.
+def channel_ranges(volume_dir):
+    entry = volume_entry(volume_dir)
+    ranges = volume_store.stored_ranges(volume_dir, entry)
+    if ranges is not None:
+        return ranges
+    channel_min, channel_max = volume_store.channel_ranges(volume_dir, entry)
+    if entry is not None:
+        store_ranges(volume_dir, entry, channel_min, channel_max)
+    return channel_min, channel_max
+
+
+# adds the ranges to the entry, unless the volume was re-indexed or changed meanwhile
+def store_ranges(volume_dir, indexed, channel_min, channel_max):
+    directory, name = os.path.split(os.path.normpath(volume_dir))
+    manifest = load_manifest(directory)
+    entry = manifest['volumes'].get(name)
+    if entry is None or entry['files'] != indexed['files'] or not is_fresh(volume_dir, entry):
+        return
+    entry['channel_min'] = np.asarray(channel_min).tolist()
+    entry['channel_max'] = np.asarray(channel_max).tolist()
+    save_manifest(directory, manifest)
+
+
+# sorted volume numbers of directory (indexing whatever is new)
+def volume_numbers(directory):
+    return sorted(entry['number'] for entry in update_manifest(directory)['volumes'].values())
+
+
+# manifest.json contents per path, with the mtime they were read at
+loaded = {}
+
+
+# The manifest entry of one volume directory, None when there is no manifest
+# or the volume changed since it was indexed (callers then scan as before).
+# A manifest is read once per process and again only when the file changes,
+# so worker processes can look up every volume they are given.
+def volume_entry(volume_dir):
+    directory, name = os.path.split(os.path.normpath(volume_dir))
+    path = manifest_path(directory)
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if path not in loaded or loaded[path][0] != mtime_ns:
+        loaded[path] = (mtime_ns, load_manifest(directory))
+    entry = loaded[path][1]['volumes'].get(name)
+    if entry is None or not is_fresh(volume_dir, entry):
+        return None
+    return entry
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build or refresh the volume manifest of a data directory')
+    parser.add_argument('dir', nargs='?', default='./test_dir')
+    parser.add_argument('--rebuild', action='store_true', help='index every volume again')
+    args = parser.parse_args()
+    manifest = update_manifest(args.dir, rebuild=args.rebuild)
+    print(f"{len(manifest['volumes'])} volumes indexed in {manifest_path(args.dir)}")
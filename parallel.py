@@ -0,0 +1,72 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker
+
+
+# raised by map_volumes when the cancel event is set
+class Cancelled(Exception):
+    pass
+
+
+# map(function, items) over a process pool, results come back in input order.
+# workers=1 (or a single item) runs in this process, workers <= 0 uses every core.
+# cancel is an optional threading.Event checked after every result; when it is
+# set, volumes that have not started are dropped and Cancelled is raised.
+# mp_context (multiprocessing.get_context(...)) picks how the workers start,
+# None is the platform default (fork on Linux).
+def map_volumes(function, items, workers=1, cancel=None, mp_context=None):
+    items = list(items)
+    if workers is not None and workers <= 0:
+        workers = os.cpu_count()
+    if workers == 1 or len(items) < 2:
+        results = map(function, items)
+        executor = None
+    else:
+        if os.name == 'posix':
+            # workers forked before the tracker runs start one each, and those
+            # unlink the shared_cohort segments they created when the pool shuts down
+            resource_tracker.ensure_running()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context)
+        results = executor.map(function, items)
+    try:
+        for result in results:
+            yield result
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+# The bookkeeping around map_volumes that both extractors share. Yields
+# (job, result) in job order, volume_dirs[i] is the volume of jobs[i].
+#   cohort    - SharedCohort: the segment (volume, kind) of every job is
+#               acquired up front and released when its result is back, or
+#               when the run stops (cancelled, failed), see shared_cohort.py
+#   records   - list for the profile records: function returns
+#               (result, record) and only result is yielded
+#   progress  - progress(done, total) after every job, once the caller is done
+#               with its result (cached it); done starts at the cached volumes
+def run_jobs(function, jobs, volume_dirs, workers=1, cancel=None, cohort=None, kind=None, records=None,
+             progress=None, done=0, total=None, mp_context=None):
+    if cohort is not None:
+        for volume_dir in volume_dirs:
+            cohort.acquire(volume_dir, kind)
+    finished = 0
+    try:
+        for job, volume_dir, result in zip(jobs, volume_dirs, map_volumes(function, jobs, workers, cancel, mp_context)):
+            if records is not None:
+                result, record = result
+                records.append(record)
+            finished += 1
+            if cohort is not None:
+                cohort.release(volume_dir, kind)
+            yield job, result
+            done += 1
+            if progress is not None:
+                progress(done, total)
+    finally:
+        # volumes that never finished (cancelled or failed) drop their references too
+        if cohort is not None:
+            for volume_dir in volume_dirs[finished:]:
+                cohort.release(volume_dir, kind)
@@ -0,0 +1,75 @@
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak memory is left out there
+    resource = None
+
+# Optional per-stage instrumentation for the batch extractors.
+#   profile = Profile('volume_7')
+#   with profile.stage('read'):
+#       ...
+#   profile.count('slices_read', 155)
+# Code that is not being profiled gets NULL_PROFILE, whose stage() and
+# count() do nothing.
+
+
+# ru_maxrss is in KB on Linux, the peak of the whole process so far
+def peak_rss_mb():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Profile:
+    def __init__(self, name):
+        self.name = name
+        self.stages = []
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        peak = peak_rss_mb()
+        try:
+            yield
+        finally:
+            process_peak = peak_rss_mb()
+            self.stages.append({
+                'stage': name,
+                'wall_s': time.perf_counter() - wall,
+                'cpu_s': time.process_time() - cpu,
+                # how far this stage pushed the peak up: 0 when it stayed under an
+                # earlier peak, so a stage's own footprint only shows the first
+                # time the process needs that much memory
+                'rss_growth_mb': None if peak is None else process_peak - peak,
+                'process_peak_rss_mb': process_peak,
+            })
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def record(self):
+        return {'name': self.name, 'stages': self.stages, 'counters': self.counters}
+
+
+class NullProfile:
+    def stage(self, name):
+        return nullcontext()
+
+    def count(self, name, value=1):
+        pass
+
+
+NULL_PROFILE = NullProfile()
+
+
+# <csv without .csv>_profile.json next to the feature csv
+def write_profile(csv_file, run_profile, volume_records):
+    path = csv_file[:-len('.csv')] + '_profile.json'
+    with open(path, 'w') as file:
+        json.dump({'run': run_profile.record(), 'volumes': volume_records}, file, indent=2)
+    return path
@@ -0,0 +1,179 @@
+import os
+import json
+import hashlib
+from collections import OrderedDict
+from multiprocessing import shared_memory
+import numpy as np
+from feature_cache import volume_fingerprint
+
+# Decoded volumes in named shared memory: worker processes attach zero-copy
+# NumPy views instead of reading and decoding the same HDF5 files again, and
+# nothing is pickled from the parent to the workers.
+#   with SharedCohort() as cohort:
+#       con.get_all(dir, workers=4, thickness=3, cohort=cohort)
+#       con.get_all(dir, workers=4, thickness=7, cohort=cohort)   # nothing is decoded again
+# A segment holds a JSON header (array names, dtypes, shapes, offsets) and the
+# arrays. Its name is a hash of the volume's files and of what was loaded
+# (kind), so a changed volume never attaches a stale segment.
+# Workers create missing segments themselves (load_shared); the parent counts
+# the jobs that still need a segment and owns its lifetime (SharedCohort).
+# Segments live in /dev/shm on Linux, which has to be large enough for them.
+SEGMENT_PREFIX = 'c4402_'
+HEADER_SIZE = 8     # bytes holding the length of the JSON header
+ALIGNMENT = 64
+
+
+def segment_name(volume_dir, kind):
+    key = f'{kind}:{os.path.abspath(volume_dir)}:{volume_fingerprint(volume_dir)}'
+    return SEGMENT_PREFIX + hashlib.sha1(key.encode()).hexdigest()[:20]
+
+
+def aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+# {name: array} -> new segment, returns the SharedMemory handle
+def publish(name, arrays):
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append([key, array.dtype.str, list(array.shape), offset])
+        offset = aligned(offset + array.nbytes)
+    header = json.dumps(layout).encode()
+    start = aligned(HEADER_SIZE + len(header))
+    shm = shared_memory.SharedMemory(name=name, create=True, size=start + offset + ALIGNMENT)
+    shm.buf[HEADER_SIZE:HEADER_SIZE + len(header)] = header
+    for (key, dtype, shape, array_offset), array in zip(layout, arrays.values()):
+        np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start + array_offset)[...] = array
+    # the header length goes in last, a segment without it is not complete (yet)
+    shm.buf[:HEADER_SIZE] = len(header).to_bytes(HEADER_SIZE, 'little')
+    return shm
+
+
+# {name: read-only view} of an existing segment, None while it is incomplete
+def views(shm):
+    length = int.from_bytes(bytes(shm.buf[:HEADER_SIZE]), 'little')
+    if length == 0:
+        return None
+    layout = json.loads(bytes(shm.buf[HEADER_SIZE:HEADER_SIZE + length]))
+    start = aligned(HEADER_SIZE + length)
+    arrays = {}
+    for key, dtype, shape, offset in layout:
+        array = np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start + offset)
+        array.flags.writeable = False
+        arrays[key] = array
+    return arrays
+
+
+# Segments this process has open. A handle can only be closed once no view
+# into it is left, so closing is retried on every later load.
+open_segments = {}
+
+
+def close_unused():
+    for name, shm in list(open_segments.items()):
+        try:
+            shm.close()
+        except BufferError:
+            continue  # a view is still alive
+        del open_segments[name]
+
+
+# Worker side: the arrays of (volume_dir, kind) from shared memory when the
+# segment exists, otherwise loader() -> {name: array}, published for the next job.
+def load_shared(volume_dir, kind, loader):
+    close_unused()
+    name = segment_name(volume_dir, kind)
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        arrays = loader()
+        try:
+            open_segments[name] = publish(name, arrays)
+        except FileExistsError:
+            pass  # published by another worker in the meantime
+        return arrays
+    arrays = views(shm)
+    if arrays is None:
+        # still being written (or its writer died), decode locally this time
+        shm.close()
+        return loader()
+    open_segments[name] = shm
+    return arrays
+
+
+# True while a segment of that name exists
+def segment_exists(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return False
+    shm.close()
+    return True
+
+
+# Parent side: reference counts and lifetime of the segments of a cohort.
+# acquire() when a job that loads (volume_dir, kind) is submitted, release()
+# when its result is back. A segment no job refers to any more is unlinked
+# right away with keep=False; with keep=True it stays for the next experiment
+# until the unreferenced segments exceed max_bytes (least recently used go
+# first) or the cohort is closed.
+class SharedCohort:
+    def __init__(self, keep=True, max_bytes=4 * 2**30):
+        self.keep = keep
+        self.max_bytes = max_bytes
+        self.segments = OrderedDict()   # name -> SharedMemory, least recently used first
+        self.references = {}
+
+    def acquire(self, volume_dir, kind):
+        name = segment_name(volume_dir, kind)
+        self.references[name] = self.references.get(name, 0) + 1
+        if name in self.segments:
+            if segment_exists(name):
+                self.segments.move_to_end(name)
+            else:
+                # unlinked behind our back, release() takes over the segment the worker creates again
+                self.segments.pop(name).close()
+        return name
+
+    def release(self, volume_dir, kind):
+        name = segment_name(volume_dir, kind)
+        self.references[name] -= 1
+        if name not in self.segments:
+            # created by the worker, the parent takes it over
+            try:
+                self.segments[name] = shared_memory.SharedMemory(name=name)
+            except FileNotFoundError:
+                pass
+        if self.references[name] == 0:
+            del self.references[name]
+            if not self.keep:
+                self.evict(name)
+        self.trim()
+
+    def nbytes(self):
+        return sum(shm.size for shm in self.segments.values())
+
+    def trim(self):
+        for name in list(self.segments):
+            if self.nbytes() <= self.max_bytes:
+                break
+            if name not in self.references:
+                self.evict(name)
+
+    def evict(self, name):
+        shm = self.segments.pop(name, None)
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+    def close(self):
+        for name in list(self.segments):
+            self.evict(name)
+        self.references.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
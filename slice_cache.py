@@ -0,0 +1,129 @@
+import threading
+from collections import OrderedDict
+import volume_store
+
+
+# Slice cache for the viewer.
+# The GUI only ever displays slices that are already in memory: request()
+# tells a background thread which slice is wanted, the thread loads it and
+# then prefetches the neighbours in the direction the user is scrolling.
+# A newer request makes the thread drop whatever it was still planning to
+# load, so dragging the slider quickly never queues up stale reads.
+# Memory is bounded by max_bytes, the least recently used slices go first.
+class SliceCache:
+    def __init__(self, max_bytes=512 * 2**20, prefetch_ahead=8, prefetch_behind=2,
+                 num_slices=155, loader=volume_store.read_slice):
+        self.max_bytes = max_bytes
+        self.prefetch_ahead = prefetch_ahead
+        self.prefetch_behind = prefetch_behind
+        self.num_slices = num_slices
+        self.loader = loader
+
+        self.condition = threading.Condition()
+        self.slices = OrderedDict()   # slice_id -> (image, mask), oldest first
+        self.errors = {}
+        self.nbytes = 0
+        self.volume_dir = None
+        self.wanted = None
+        self.direction = 1
+        self.generation = 0           # bumped on every request / volume change
+        self.epoch = 0                # bumped when cached slices become stale
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # switching volume empties the cache
+    def set_volume(self, volume_dir):
+        with self.condition:
+            if volume_dir == self.volume_dir:
+                return
+            self.volume_dir = volume_dir
+            self.slices.clear()
+            self.errors.clear()
+            self.nbytes = 0
+            self.wanted = None
+            self.epoch += 1
+            self.generation += 1
+
+    # drops the cached slices of volume_dir (the loader would return something
+    # else for them now) and loads the wanted slice again; safe from any thread
+    def reload(self, volume_dir):
+        with self.condition:
+            if volume_dir != self.volume_dir:
+                return
+            self.slices.clear()
+            self.errors.clear()
+            self.nbytes = 0
+            self.epoch += 1
+            self.generation += 1
+            self.condition.notify()
+
+    # (image, mask) if the slice is cached, otherwise None
+    def get(self, slice_id):
+        with self.condition:
+            if slice_id not in self.slices:
+                return None
+            self.slices.move_to_end(slice_id)
+            return self.slices[slice_id]
+
+    # the exception raised while loading slice_id, if loading failed
+    def error(self, slice_id):
+        with self.condition:
+            return self.errors.get(slice_id)
+
+    def request(self, slice_id):
+        with self.condition:
+            if self.wanted is not None and slice_id != self.wanted:
+                self.direction = 1 if slice_id > self.wanted else -1
+            self.wanted = slice_id
+            self.generation += 1
+            self.condition.notify()
+
+    def put(self, slice_id, data):
+        if slice_id in self.slices:
+            return
+        self.slices[slice_id] = data
+        self.nbytes += sum(array.nbytes for array in data)
+        # evict least recently used first, but never the slice that is wanted right now
+        for old_id in list(self.slices):
+            if self.nbytes <= self.max_bytes:
+                break
+            if old_id != self.wanted and old_id != slice_id:
+                self.nbytes -= sum(array.nbytes for array in self.slices.pop(old_id))
+
+    # wanted slice first, then the ones ahead, then a few behind
+    def plan(self):
+        ahead = [self.wanted + self.direction * k for k in range(1, self.prefetch_ahead + 1)]
+        behind = [self.wanted - self.direction * k for k in range(1, self.prefetch_behind + 1)]
+        # the wanted slice is always tried so a bad id ends up in errors
+        prefetch = [slice_id for slice_id in ahead + behind if 0 <= slice_id < self.num_slices]
+        return [slice_id for slice_id in [self.wanted] + prefetch
+                if slice_id not in self.slices and slice_id not in self.errors]
+
+    def run(self):
+        done = 0
+        while True:
+            with self.condition:
+                while self.generation == done or self.wanted is None:
+                    if self.wanted is None:
+                        done = self.generation
+                    self.condition.wait()
+                done = self.generation
+                volume_dir = self.volume_dir
+                epoch = self.epoch
+                slice_ids = self.plan()
+
+            for slice_id in slice_ids:
+                with self.condition:
+                    if self.generation != done:
+                        break  # stale, a newer request is waiting
+                try:
+                    data = self.loader(volume_dir, slice_id)
+                except Exception as exception:
+                    with self.condition:
+                        if epoch == self.epoch:
+                            self.errors[slice_id] = exception
+                    continue
+                with self.condition:
+                    if epoch == self.epoch:
+                        self.put(slice_id, data)
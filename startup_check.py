@@ -0,0 +1,64 @@
+import sys
+import argparse
+import subprocess
+
+# Import time report and startup budget for the viewer.
+#   python startup_check.py                  # report, check the budget
+#   python startup_check.py --budget 0.4 --top 30
+# Imports GUI03 in fresh interpreters with -X importtime (best of --repeat
+# runs), prints the slowest top level imports and exits with status 1 when
+# the import takes longer than --budget seconds or pulls in one of the
+# extraction backends, which the viewer must only load on demand.
+forbidden = ['matplotlib', 'scipy', 'SimpleITK', 'radiomics', 'get_conventional', 'get_radiomics']
+
+
+# [(self us, cumulative us, module, depth)] for one fresh import of module
+def import_report(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"import {module} failed:\n{result.stderr}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), name.strip(), depth))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Import time report and startup budget for GUI03')
+    parser.add_argument('--module', default='GUI03')
+    parser.add_argument('--budget', type=float, default=0.6, help='allowed import time in seconds')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='top level imports to list')
+    args = parser.parse_args()
+
+    runs = [import_report(args.module) for _ in range(args.repeat)]
+    # the module itself is the last line, its cumulative time is the whole import
+    report = min(runs, key=lambda rows: rows[-1][1])
+    total = report[-1][1] / 1e6
+
+    # direct imports of the module (depth 1) and the module itself
+    top_level = [row for row in report if row[3] <= 1]
+    for self_us, cumulative_us, name, depth in sorted(top_level, key=lambda row: -row[1])[:args.top]:
+        print(f"{cumulative_us / 1000:9.1f} ms  {name}")
+
+    failed = False
+    loaded = {name for _, _, name, _ in report}
+    backends = [name for name in forbidden if any(module == name or module.startswith(name + '.') for module in loaded)]
+    if backends:
+        print("Imported at startup (should be deferred):", ', '.join(backends))
+        failed = True
+    print(f"import {args.module}: {total:.3f} s (budget {args.budget:.3f} s)")
+    if total > args.budget:
+        print("Over the startup budget")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
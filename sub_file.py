@@ -1,6 +1,8 @@
 import os
 import re
 import shutil
+import volume_store
+import thumbnails
 
 
 # This script will create sub file
@@ -50,4 +52,17 @@ for i in range(1, 369):
     if os.path.exists(volume_path):
         shutil.copy(os.path.join(source_directory, file), destination_directory)
 
+# Pack each volume's slices into one volume_N/packed.h5 so the feature
+# extractors and the GUI open one file per volume instead of one per slice.
+# The slice files are kept, everything still reads them if packed.h5 is missing.
+for i in range(1, 370):
+    volume_path = os.path.join(base_path, f'volume_{i}')
+    if os.path.exists(volume_path):
+        volume_store.pack_volume(volume_path)
 
+# Downsampled previews of every slice (volume_N/thumbnails.h5) for the
+# montage view of GUI03.py, built from packed.h5.
+for i in range(1, 370):
+    volume_path = os.path.join(base_path, f'volume_{i}')
+    if os.path.exists(volume_path):
+        thumbnails.build_thumbnails(volume_path)
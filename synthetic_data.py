@@ -0,0 +1,60 @@
+import os
+import argparse
+import h5py
+import numpy as np
+
+# BraTS shaped synthetic volumes in the per-slice layout
+# (volume_N/volume_N_slice_K.h5 with image (H, W, 4) float64, mask (H, W, 3) uint8)
+# for benchmarks. tumor_radius sets the size of the main tumor, fragments adds
+# that many small extra blobs per tumor slice (many components per slice).
+
+
+def make_volume(volume_dir, volume_number, slices=155, size=240, tumor_radius=30, fragments=0, seed=0):
+    rng = np.random.default_rng(seed)
+    os.makedirs(volume_dir, exist_ok=True)
+    yy, xx = np.mgrid[:size, :size]
+    center = size / 2
+    brain = ((yy - center) / (0.42 * size)) ** 2 + ((xx - center) / (0.34 * size)) ** 2 < 1
+    tumor_y, tumor_x = rng.uniform(0.4 * size, 0.6 * size, 2)
+    tumor_z = slices / 2
+
+    for k in range(slices):
+        image = np.zeros((size, size, 4))
+        for channel in range(4):
+            image[..., channel] = brain * rng.normal(100 + 50 * channel, 20, (size, size))
+        image += rng.normal(0, 2, image.shape)
+
+        mask = np.zeros((size, size, 3), dtype=np.uint8)
+        # tumor is a sphere: radius shrinks away from the middle slice
+        radius = np.sqrt(max(tumor_radius ** 2 - (k - tumor_z) ** 2, 0))
+        if radius > 0:
+            distance = np.sqrt((yy - tumor_y) ** 2 + (xx - tumor_x) ** 2)
+            mask[..., 0] = distance < 0.4 * radius                             # necrotic core
+            mask[..., 2] = (distance >= 0.4 * radius) & (distance < 0.7 * radius)  # enhancing
+            mask[..., 1] = (distance >= 0.7 * radius) & (distance < radius)       # edema
+            for _ in range(fragments):
+                y, x = rng.uniform(0.2 * size, 0.8 * size, 2)
+                mask[..., 1] |= (np.sqrt((yy - y) ** 2 + (xx - x) ** 2) < rng.uniform(1, 3)) & ~mask.any(axis=-1)
+            image[mask.any(axis=-1)] += 80
+
+        with h5py.File(os.path.join(volume_dir, f'volume_{volume_number}_slice_{k}.h5'), 'w') as file:
+            file['image'] = image
+            file['mask'] = mask
+
+
+def make_cohort(directory, volumes=3, **kwargs):
+    for i in range(1, volumes + 1):
+        make_volume(os.path.join(directory, f'volume_{i}'), i, seed=i, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic BraTS shaped volumes')
+    parser.add_argument('dir')
+    parser.add_argument('--volumes', type=int, default=3)
+    parser.add_argument('--slices', type=int, default=155)
+    parser.add_argument('--size', type=int, default=240)
+    parser.add_argument('--radius', type=float, default=30)
+    parser.add_argument('--fragments', type=int, default=0)
+    args = parser.parse_args()
+    make_cohort(args.dir, args.volumes, slices=args.slices, size=args.size,
+                tumor_radius=args.radius, fragments=args.fragments)
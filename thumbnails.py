@@ -0,0 +1,171 @@
+import os
+import argparse
+import h5py
+import numpy as np
+
+import volume_store
+import manifest
+from display import to_display, render
+from feature_cache import volume_fingerprint
+
+# Preview pyramid of a volume for the viewer's montage, one thumbnails.h5
+# per volume directory next to packed.h5:
+#   slice_ids              slice numbers in slice order
+#   attrs['frame_shape']   (H, W) of a full size frame
+#   level_<f>/channels     (slices, channels, H/f, W/f) uint8
+#   level_<f>/outline      (slices, H/f, W/f) bool, border of the tumor labels
+# for every factor f in levels. The previews are display ready like the
+# frames of display.py (same per volume normalisation, already rotated), every
+# level is the 2x2 mean of the one before. The montage reads one level and
+# never opens the slices.
+#   python thumbnails.py <dir>             # build / refresh for every volume
+#   python thumbnails.py <dir> --rebuild
+THUMBNAILS_NAME = 'thumbnails.h5'
+
+# bump when the previews change, older files are rebuilt
+thumbnails_version = 1
+
+levels = (2, 4, 8)
+
+
+def thumbnails_path(volume_dir):
+    return os.path.join(volume_dir, THUMBNAILS_NAME)
+
+
+# True while thumbnails.h5 was built from the current slices
+def is_fresh(volume_dir):
+    try:
+        with h5py.File(thumbnails_path(volume_dir), 'r') as file:
+            return (file.attrs.get('version') == thumbnails_version
+                    and file.attrs.get('fingerprint') == volume_fingerprint(volume_dir))
+    except OSError:
+        return False
+
+
+# mean over factor x factor blocks of the last two axes
+def downsample(array, factor):
+    height, width = array.shape[-2] // factor, array.shape[-1] // factor
+    array = array[..., :height * factor, :width * factor]
+    blocks = array.reshape(array.shape[:-2] + (height, factor, width, factor))
+    return blocks.mean(axis=(-3, -1))
+
+
+# tumor pixels with a 4-neighbour outside the tumor
+def outline(mask):
+    padded = np.pad(mask, 1)
+    inner = padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:]
+    return mask & ~inner
+
+
+# Write thumbnails.h5 for one volume (nothing to do while it is fresh).
+# Returns the path, None for a volume without slices.
+def build_thumbnails(volume_dir, rebuild=False):
+    target = thumbnails_path(volume_dir)
+    if not rebuild and is_fresh(volume_dir):
+        return target
+    fingerprint = volume_fingerprint(volume_dir)
+    entry = manifest.volume_entry(volume_dir) or volume_store.index_volume(volume_dir)
+    if entry is None:
+        return None
+    channel_min, channel_max = manifest.channel_ranges(volume_dir)
+
+    frame_shape = None
+    previews = {factor: [] for factor in levels}
+    outlines = {factor: [] for factor in levels}
+    for image, mask in volume_store.iter_slices(volume_dir):
+        channels, overlay = to_display(image, mask, channel_min, channel_max)
+        frame_shape = overlay.shape
+        channels, overlay = channels.astype(np.float32), overlay.astype(np.float32)
+        factor = 1
+        for level in levels:
+            channels = downsample(channels, level // factor)
+            overlay = downsample(overlay, level // factor)
+            factor = level
+            previews[level].append(np.round(channels).astype(np.uint8))
+            # a preview pixel is tumor when any of its pixels is
+            outlines[level].append(outline(overlay > 0))
+
+    # written under a temporary name, an interrupted build leaves no half file
+    tmp_path = f'{target}.{os.getpid()}.tmp'
+    with h5py.File(tmp_path, 'w') as file:
+        file.create_dataset('slice_ids', data=np.array(entry['slice_ids'], dtype=np.int32))
+        for level in levels:
+            group = file.create_group(f'level_{level}')
+            group.create_dataset('channels', data=np.stack(previews[level]), compression='lzf')
+            group.create_dataset('outline', data=np.stack(outlines[level]), compression='lzf')
+        file.attrs['frame_shape'] = frame_shape
+        file.attrs['version'] = thumbnails_version
+        file.attrs['fingerprint'] = fingerprint
+    os.replace(tmp_path, target)
+    # the new file changed the directory mtime, not what the manifest indexed
+    manifest.touch_entry(volume_dir)
+    return target
+
+
+# Build the previews of every volume_N directory in directory
+def build_all(directory, rebuild=False):
+    for name, number in sorted(manifest.volume_dirs(directory).items(), key=lambda item: item[1]):
+        if build_thumbnails(os.path.join(directory, name), rebuild=rebuild) is not None:
+            print("Previews for", name)
+
+
+# (level, columns) of the most detailed grid of count tiles that fits in
+# max_size pixels (width and height), the smallest level if none does.
+# frame_shape is the (H, W) of a full size frame.
+def montage_layout(count, frame_shape, max_size=900, gap=2):
+    columns = max(1, int(np.ceil(np.sqrt(count))))
+    rows = -(-count // columns)
+    for level in levels:
+        height, width = frame_shape[0] // level, frame_shape[1] // level
+        if columns * (width + gap) <= max_size and rows * (height + gap) <= max_size:
+            return level, columns
+    return levels[-1], columns
+
+
+# What the montage of volume_dir needs: {'slice_ids', 'channels', 'outline',
+# 'columns'} with the previews of the level chosen by montage_layout, one
+# read of thumbnails.h5. None when the volume has no fresh previews.
+def load_montage(volume_dir, max_size=900, gap=2):
+    if not is_fresh(volume_dir):
+        return None
+    with h5py.File(thumbnails_path(volume_dir), 'r') as file:
+        slice_ids = file['slice_ids'][()]
+        level, columns = montage_layout(len(slice_ids), file.attrs['frame_shape'], max_size, gap)
+        group = file[f'level_{level}']
+        return {'slice_ids': slice_ids, 'channels': group['channels'][()], 'outline': group['outline'][()],
+                'columns': columns}
+
+
+# (count, h, w) tiles -> one (rows * (h + gap), columns * (w + gap)) image,
+# row by row, the gaps and the unused tiles are 0
+def montage(tiles, columns, gap=2):
+    count, height, width = tiles.shape
+    rows = -(-count // columns)
+    grid = np.zeros((rows * columns, height + gap, width + gap), dtype=tiles.dtype)
+    grid[:count, :height, :width] = tiles
+    grid = grid.reshape(rows, columns, height + gap, width + gap)
+    return np.ascontiguousarray(grid.transpose(0, 2, 1, 3).reshape(rows * (height + gap), columns * (width + gap)))
+
+
+# RGB montage of one channel, tumor outlines blended in like the annotation of a slice
+def render_montage(channels, outlines, channel_id, columns, annotate=False, gap=2):
+    grid = montage(channels[:, channel_id], columns, gap)
+    return render(grid[None], montage(outlines, columns, gap), 0, annotate=annotate)
+
+
+# index of the tile under pixel (x, y) of a montage, None for a gap or an unused tile
+def tile_at(x, y, count, tile_shape, columns, gap=2):
+    row, y = divmod(y, tile_shape[0] + gap)
+    column, x = divmod(x, tile_shape[1] + gap)
+    index = row * columns + column
+    if x >= tile_shape[1] or y >= tile_shape[0] or column >= columns or not 0 <= index < count:
+        return None
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the montage previews of every volume in a data directory')
+    parser.add_argument('dir', nargs='?', default='./test_dir')
+    parser.add_argument('--rebuild', action='store_true', help='build every volume again')
+    args = parser.parse_args()
+    build_all(args.dir, rebuild=args.rebuild)
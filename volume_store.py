@@ -0,0 +1,400 @@
+import os
+import re
+import h5py
+import numpy as np
+
+# Packed layout: one 'packed.h5' per volume directory holding
+#   image     (slices, H, W, channels)
+#   mask      (slices, H, W, 3)
+#   slice_ids (slices,)  original slice numbers from the file names
+# Everything here falls back to the legacy volume_N_slice_K.h5 files when
+# a volume has not been packed yet.
+PACKED_NAME = 'packed.h5'
+
+# BraTS subregion of every mask channel: necrotic / non-enhancing tumor core,
+# peritumoral edema, GD-enhancing tumor
+mask_regions = {'NCR': 0, 'ED': 1, 'ET': 2}
+
+slice_pattern = re.compile(r'volume_(\d+)_slice_(\d+)\.h5$')
+
+
+def packed_path(volume_dir):
+    return os.path.join(volume_dir, PACKED_NAME)
+
+
+def is_packed(volume_dir):
+    return os.path.exists(packed_path(volume_dir))
+
+
+# False for a volume directory without packed.h5 or slice files (not copied
+# yet); index_volume skips those, so they are not in the manifest either
+def has_slices(volume_dir):
+    return is_packed(volume_dir) or bool(slice_files(volume_dir))
+
+
+# sorted list of (slice_id, path) for the legacy per-slice files,
+# anything that is not a slice file (csv, packed.h5 ...) is ignored.
+# With a manifest entry (see manifest.py) the directory is not listed again.
+def slice_files(volume_dir, entry=None):
+    if entry is not None and not entry['packed']:
+        return [(slice_id, os.path.join(volume_dir, name))
+                for slice_id, (name, _, _) in zip(entry['slice_ids'], entry['files'])]
+    files = []
+    for filename in os.listdir(volume_dir):
+        match = slice_pattern.search(filename)
+        if match:
+            files.append((int(match.group(2)), os.path.join(volume_dir, filename)))
+    return sorted(files)
+
+
+def legacy_slice_path(volume_dir, slice_id):
+    volume_number = re.search(r'volume_(\d+)', os.path.basename(os.path.normpath(volume_dir))).group(1)
+    return os.path.join(volume_dir, f'volume_{volume_number}_slice_{slice_id}.h5')
+
+
+# running per channel min/max of (H, W, channels) slices
+def update_ranges(image, image_min, image_max):
+    slice_min = image.min(axis=(0, 1))
+    slice_max = image.max(axis=(0, 1))
+    if image_min is None:
+        return slice_min, slice_max
+    return np.minimum(image_min, slice_min), np.maximum(image_max, slice_max)
+
+
+# (min, max) per image channel over the whole volume where it is stored: in
+# packed.h5 by pack_volume, in the manifest entry (copied from packed.h5 or
+# kept by manifest.channel_ranges). None when it was never computed.
+def stored_ranges(volume_dir, entry=None):
+    if entry is not None and 'channel_min' in entry:
+        return np.array(entry['channel_min']), np.array(entry['channel_max'])
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            attrs = file['image'].attrs
+            if 'channel_min' in attrs:
+                return attrs['channel_min'], attrs['channel_max']
+    return None
+
+
+# stored_ranges, computed from every slice when there are none
+def channel_ranges(volume_dir, entry=None):
+    ranges = stored_ranges(volume_dir, entry)
+    if ranges is not None:
+        return ranges
+    image_min = image_max = None
+    for image, _ in iter_slices(volume_dir):
+        image_min, image_max = update_ranges(image, image_min, image_max)
+    return image_min, image_max
+
+
+# Pack all slice files of one volume into packed.h5.
+# The file is written under a temporary name first so an interrupted run
+# never leaves a half written container behind.
+def pack_volume(volume_dir, compression='gzip', compression_opts=4, remove_slices=False, overwrite=False):
+    target = packed_path(volume_dir)
+    if os.path.exists(target) and not overwrite:
+        return target
+    files = slice_files(volume_dir)
+    if not files:
+        return None
+
+    with h5py.File(files[0][1], 'r') as first:
+        image_shape, image_dtype = first['image'].shape, first['image'].dtype
+        mask_shape, mask_dtype = first['mask'].shape, first['mask'].dtype
+
+    n = len(files)
+    # One chunk per slice and image channel: a single slice (GUI) touches
+    # only its own chunks, a whole volume read walks the chunks in order and
+    # a single channel (radiomics uses channel 0) can be read without
+    # decompressing the other three.
+    image_chunks = (1,) + image_shape[:-1] + (1,) if len(image_shape) == 3 else (1,) + image_shape
+    tmp_path = target + '.tmp'
+    with h5py.File(tmp_path, 'w') as out:
+        image_ds = out.create_dataset('image', shape=(n,) + image_shape, dtype=image_dtype,
+                                      chunks=image_chunks, shuffle=True,
+                                      compression=compression, compression_opts=compression_opts)
+        mask_ds = out.create_dataset('mask', shape=(n,) + mask_shape, dtype=mask_dtype,
+                                     chunks=(1,) + mask_shape, shuffle=True,
+                                     compression=compression, compression_opts=compression_opts)
+        out.create_dataset('slice_ids', data=np.array([slice_id for slice_id, _ in files], dtype=np.int32))
+        image_min = image_max = None
+        for i, (_, path) in enumerate(files):
+            with h5py.File(path, 'r') as file:
+                image = file['image'][()]
+                image_ds[i] = image
+                mask_ds[i] = file['mask'][()]
+            image_min, image_max = update_ranges(image, image_min, image_max)
+        # per channel value range, the viewer normalises with it without reading the volume
+        image_ds.attrs['channel_min'] = image_min
+        image_ds.attrs['channel_max'] = image_max
+    os.replace(tmp_path, target)
+
+    if remove_slices:
+        for _, path in files:
+            os.remove(path)
+    return target
+
+
+# Pack every volume_N directory found in directory
+def pack_all(directory):
+    for item in sorted(os.listdir(directory)):
+        volume_dir = os.path.join(directory, item)
+        if os.path.isdir(volume_dir) and re.match(r'volume_\d+$', item):
+            pack_volume(volume_dir)
+            print("Packed", volume_dir)
+
+
+# Yield (image, mask) slice by slice in slice order
+def iter_slices(volume_dir):
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            image_ds, mask_ds = file['image'], file['mask']
+            for i in range(image_ds.shape[0]):
+                yield image_ds[i], mask_ds[i]
+    else:
+        for _, path in slice_files(volume_dir):
+            with h5py.File(path, 'r') as file:
+                yield file['image'][()], file['mask'][()]
+
+
+# Like iter_slices but only for slices whose mask has tumor: the mask is read
+# first and the image (most of the bytes) only when the slice is kept.
+# With a manifest entry the empty slices are known and not touched at all.
+# stats['slices'] is set to the number of slices in the volume when a dict is given.
+def iter_tumor_slices(volume_dir, stats=None, entry=None):
+    if stats is None:
+        stats = {}
+    if entry is not None:
+        stats['slices'] = len(entry['tumor'])
+        indices = np.flatnonzero(entry['tumor'])
+        if entry['packed']:
+            with h5py.File(packed_path(volume_dir), 'r') as file:
+                image_ds, mask_ds = file['image'], file['mask']
+                for i in indices:
+                    yield image_ds[i], mask_ds[i]
+        else:
+            files = slice_files(volume_dir, entry)
+            for i in indices:
+                with h5py.File(files[i][1], 'r') as file:
+                    yield file['image'][()], file['mask'][()]
+        return
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            masks = file['mask'][()]
+            image_ds = file['image']
+            stats['slices'] = len(masks)
+            for i in np.flatnonzero(masks.reshape(len(masks), -1).any(axis=1)):
+                yield image_ds[i], masks[i]
+    else:
+        files = slice_files(volume_dir)
+        stats['slices'] = len(files)
+        for _, path in files:
+            with h5py.File(path, 'r') as file:
+                mask = file['mask'][()]
+                if np.any(mask):
+                    yield file['image'][()], mask
+
+
+# Whole volume as (slices, H, W, channels), (slices, H, W, 3)
+def read_volume(volume_dir):
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            return file['image'][()], file['mask'][()]
+    images = []
+    masks = []
+    for image, mask in iter_slices(volume_dir):
+        images.append(image)
+        masks.append(mask)
+    return np.stack(images), np.stack(masks)
+
+
+# (slices, H, W) of the volume
+def volume_shape(volume_dir, entry=None):
+    if entry is not None:
+        return (len(entry['slice_ids']),) + tuple(entry['mask_shape'][:2])
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            return file['mask'].shape[:3]
+    files = slice_files(volume_dir)
+    with h5py.File(files[0][1], 'r') as file:
+        return (len(files),) + file['mask'].shape[:2]
+
+
+# (z, y, x) slices around the non-zero voxels of a (slices, H, W) mask,
+# grown by margin voxels on every side and clipped to the volume
+def mask_box(mask, margin=0):
+    box = []
+    for axis in range(3):
+        other = tuple(a for a in range(3) if a != axis)
+        hits = np.flatnonzero(np.any(mask, axis=other))
+        if len(hits) == 0:
+            return tuple(slice(0, n) for n in mask.shape)
+        box.append(slice(max(hits[0] - margin, 0), min(hits[-1] + 1 + margin, mask.shape[axis])))
+    return tuple(box)
+
+
+# One image channel as (slices, H, W), optionally only inside box, read by
+# HDF5 straight into one preallocated array of dtype (the conversion from
+# the stored float64 happens during the read, no float64 copy is made)
+def read_image_channel(volume_dir, channel=0, box=None, dtype=np.float32, entry=None):
+    if box is None:
+        box = tuple(slice(0, n) for n in volume_shape(volume_dir, entry))
+    out = np.empty(tuple(s.stop - s.start for s in box), dtype=dtype)
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            file['image'].read_direct(out, box + (channel,))
+        return out
+    for i, (_, path) in enumerate(slice_files(volume_dir, entry)[box[0]]):
+        with h5py.File(path, 'r') as file:
+            file['image'].read_direct(out, box[1:] + (channel,), np.s_[i])
+    return out
+
+
+# Tumor labels of all mask channels added up, (slices, H, W), or only the part
+# inside a (z, y, x) box. With a manifest entry only slices that have tumor
+# are read, the rest is known to be zero.
+def read_mask_sum(volume_dir, dtype=np.uint8, entry=None, box=None):
+    if box is None:
+        box = tuple(slice(0, n) for n in volume_shape(volume_dir, entry))
+    out = np.zeros(tuple(s.stop - s.start for s in box), dtype=dtype)
+    indices = list(range(box[0].start, box[0].stop))
+    if entry is not None:
+        indices = [i for i in indices if entry['tumor'][i]]
+    if not indices:
+        return out
+    if is_packed(volume_dir):
+        first, last = indices[0], indices[-1] + 1
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            out[first - box[0].start:last - box[0].start] = \
+                file['mask'][first:last, box[1], box[2]].sum(axis=-1, dtype=dtype)
+        return out
+    files = slice_files(volume_dir, entry)
+    for i in indices:
+        with h5py.File(files[i][1], 'r') as file:
+            out[i - box[0].start] = file['mask'][box[1], box[2]].sum(axis=-1, dtype=dtype)
+    return out
+
+
+# The mask channels as (slices, H, W, 3), or only the part inside a (z, y, x)
+# box; read like read_mask_sum
+def read_masks(volume_dir, entry=None, box=None):
+    if box is None:
+        box = tuple(slice(0, n) for n in volume_shape(volume_dir, entry))
+    if entry is not None:
+        channels, dtype = entry['mask_shape'][-1], np.dtype(entry['mask_dtype'])
+    else:
+        path = packed_path(volume_dir) if is_packed(volume_dir) else slice_files(volume_dir)[0][1]
+        with h5py.File(path, 'r') as file:
+            channels, dtype = file['mask'].shape[-1], file['mask'].dtype
+    out = np.zeros(tuple(s.stop - s.start for s in box) + (channels,), dtype=dtype)
+    indices = list(range(box[0].start, box[0].stop))
+    if entry is not None:
+        indices = [i for i in indices if entry['tumor'][i]]
+    if not indices:
+        return out
+    if is_packed(volume_dir):
+        first, last = indices[0], indices[-1] + 1
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            out[first - box[0].start:last - box[0].start] = file['mask'][first:last, box[1], box[2]]
+        return out
+    files = slice_files(volume_dir, entry)
+    for i in indices:
+        with h5py.File(files[i][1], 'r') as file:
+            out[i - box[0].start] = file['mask'][box[1], box[2]]
+    return out
+
+
+# (z, y, x) slices around the tumor of a whole volume grown by margin voxels
+# and clipped to the volume. With a manifest entry the box comes from the
+# stored per-slice boxes and no mask is read.
+def tumor_box(volume_dir, margin=0, entry=None):
+    if entry is None:
+        return mask_box(read_mask_sum(volume_dir), margin)
+    shape = volume_shape(volume_dir, entry)
+    boxes = [box for box in entry['boxes'] if box is not None]
+    if not boxes:
+        return tuple(slice(0, n) for n in shape)
+    tumor_slices = np.flatnonzero(entry['tumor'])
+    starts = [tumor_slices[0], min(box[0] for box in boxes), min(box[2] for box in boxes)]
+    stops = [tumor_slices[-1] + 1, max(box[1] for box in boxes), max(box[3] for box in boxes)]
+    return tuple(slice(int(max(start - margin, 0)), int(min(stop + margin, n)))
+                 for start, stop, n in zip(starts, stops, shape))
+
+
+# One slice by its slice number (as in volume_N_slice_K.h5)
+def read_slice(volume_dir, slice_id):
+    if is_packed(volume_dir):
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            slice_ids = file['slice_ids'][()]
+            index = int(np.searchsorted(slice_ids, slice_id))
+            if index >= len(slice_ids) or slice_ids[index] != slice_id:
+                raise KeyError(f"slice {slice_id} not in {packed_path(volume_dir)}")
+            return file['image'][index], file['mask'][index]
+    with h5py.File(legacy_slice_path(volume_dir, slice_id), 'r') as file:
+        return file['image'][()], file['mask'][()]
+
+
+# (name, size, mtime_ns) of the files a volume is read from
+def file_stats(volume_dir, names):
+    stats = []
+    for name in names:
+        stat = os.stat(os.path.join(volume_dir, name))
+        stats.append((name, stat.st_size, stat.st_mtime_ns))
+    return stats
+
+
+# Everything the loaders need to plan their reads, collected with one pass
+# over the volume (stored per volume by manifest.py, None for a volume without slices):
+#   files                 (name, size, mtime_ns) of packed.h5 or of every slice file
+#   slice_ids             slice numbers in slice order
+#   image_shape/dtype,
+#   mask_shape/dtype      of one slice
+#   tumor                 per slice: mask has any tumor label
+#   boxes                 per slice: [y0, y1, x0, x1] around the tumor, None without tumor
+#   channel_min/max       per channel value range of the volume, when packed.h5
+#                         has them; otherwise added by manifest.channel_ranges
+#                         the first time the viewer or the previews need them
+# Only masks are read: indexing runs serially before the extraction starts.
+def index_volume(volume_dir):
+    entry = {'packed': is_packed(volume_dir), 'tumor': [], 'boxes': []}
+    if entry['packed']:
+        names = [PACKED_NAME]
+        with h5py.File(packed_path(volume_dir), 'r') as file:
+            image_ds, mask_ds = file['image'], file['mask']
+            entry['slice_ids'] = file['slice_ids'][()].tolist()
+            image_shape, image_dtype = image_ds.shape[1:], image_ds.dtype
+            mask_shape, mask_dtype = mask_ds.shape[1:], mask_ds.dtype
+            masks = mask_ds[()]
+            if 'channel_min' in image_ds.attrs:
+                entry['channel_min'] = np.asarray(image_ds.attrs['channel_min']).tolist()
+                entry['channel_max'] = np.asarray(image_ds.attrs['channel_max']).tolist()
+    else:
+        files = slice_files(volume_dir)
+        if not files:
+            return None
+        names = [os.path.basename(path) for _, path in files]
+        entry['slice_ids'] = [slice_id for slice_id, _ in files]
+        masks = []
+        for _, path in files:
+            with h5py.File(path, 'r') as file:
+                masks.append(file['mask'][()])
+                image_shape, image_dtype = file['image'].shape, file['image'].dtype
+        mask_shape, mask_dtype = masks[-1].shape, masks[-1].dtype
+
+    for mask in masks:
+        tumor = mask.reshape(mask.shape[0], mask.shape[1], -1).any(axis=-1)
+        rows = np.flatnonzero(tumor.any(axis=1))
+        columns = np.flatnonzero(tumor.any(axis=0))
+        entry['tumor'].append(bool(len(rows)))
+        entry['boxes'].append([int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1]
+                              if len(rows) else None)
+    entry['files'] = file_stats(volume_dir, names)
+    entry['image_shape'] = list(image_shape)
+    entry['image_dtype'] = str(image_dtype)
+    entry['mask_shape'] = list(mask_shape)
+    entry['mask_dtype'] = str(mask_dtype)
+    return entry
+
+
+if __name__ == '__main__':
+    import sys
+    pack_all(sys.argv[1] if len(sys.argv) > 1 else './test_dir')